@@ -1,9 +1,10 @@
 import torch
 import cv2
 import numpy as np
-from typing import List, Tuple
+from typing import List, Tuple, Optional
 import glob
 import os
+import math
 
 
 def color_mod(img: torch.Tensor, rgb: torch.Tensor, num_bins: int) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -108,8 +109,9 @@ def histogram(img: torch.Tensor, mask: torch.Tensor, channels: List[int] = [32,
         tgt_img = tgt_img[..., 0] + channels[0] * tgt_img[..., 1] + channels[0] * channels[1] * tgt_img[..., 2]  # (B, H, W)
         tgt_img *= final_mask.float()
         tgt_img = tgt_img.reshape(tgt_img.shape[0], -1).long()  # (B, H * W)
-        hist = torch.zeros([tgt_img.shape[0], channels[0] * channels[1] * channels[2]], device=tgt_img.device, dtype=torch.long).scatter_add(
-            dim=-1, index=tgt_img, src=torch.ones_like(tgt_img, dtype=torch.long))  # (B, C)
+        # Bin counts are bounded by H * W, so they are accumulated in int32
+        hist = torch.zeros([tgt_img.shape[0], channels[0] * channels[1] * channels[2]], device=tgt_img.device, dtype=torch.int32).scatter_add(
+            dim=-1, index=tgt_img, src=torch.ones_like(tgt_img, dtype=torch.int32))  # (B, C)
         hist[:, 0] -= (~final_mask).reshape(tgt_img.shape[0], -1).sum(-1)  # Subtract zeros from final mask
         hist = hist.float()
 
@@ -121,6 +123,69 @@ def histogram(img: torch.Tensor, mask: torch.Tensor, channels: List[int] = [32,
     return hist
 
 
+def split_histogram(img: torch.Tensor, mask: torch.Tensor, num_split_h: int, num_split_w: int, channels: List[int] = [8, 8, 8],
+        normalize=True, unit_range: Optional[bool] = None) -> torch.Tensor:
+    """
+    Returns color histograms of the split patches of an input image, computed with a single scatter over the full image
+
+    Args:
+        img: (..., H, W, 3) torch tensor containing RGB values. Each patch is (H // num_split_h, W // num_split_w) pixels,
+            and leftover rows and columns when H or W is not divisible by the number of splits are ignored
+        mask: (..., H, W) torch tensor with mask values, broadcastable to the shape of img
+        num_split_h: Number of split along horizontal direction
+        num_split_w: Number of split along vertical direction
+        channels: List of length 3 containing number of bins per each channel
+        normalize: If True, normalizes histogram
+        unit_range: If True, RGB values are in [0, 1], and if False in [0, 255]. If None, the range is inferred from the maximum value,
+            which synchronizes with the device
+
+    Returns:
+        hist: (..., num_split_h * num_split_w, *channels) histograms of patches in row-major order
+    """
+
+    batch_shape = img.shape[:-3]
+    num_chunks = num_split_h * num_split_w
+    num_bins = channels[0] * channels[1] * channels[2]
+
+    # Crop to a multiple of the patch size, so that every pixel maps to a valid patch
+    block_h, block_w = img.shape[-3] // num_split_h, img.shape[-2] // num_split_w
+    H, W = block_h * num_split_h, block_w * num_split_w
+    mask = mask.expand(img.shape[:-1])[..., :H, :W]
+    img = img[..., :H, :W, :]
+
+    # Make the color of an image to be in range (0, 255)
+    # Bin sizes are kept as Python ints, since building them as tensors would copy to the device on every call
+    tgt_img = img.detach()
+    bin_size = [math.ceil(255 / num_channel) for num_channel in channels]
+
+    if unit_range is None:
+        unit_range = bool(tgt_img.max() <= 1)
+    if unit_range:
+        tgt_img = tgt_img * 255
+    tgt_rgb = tgt_img.long()
+    bin_idx = tgt_rgb[..., 0] // bin_size[0] + channels[0] * (tgt_rgb[..., 1] // bin_size[1]) \
+        + channels[0] * channels[1] * (tgt_rgb[..., 2] // bin_size[2])  # (..., H, W)
+
+    # Lookup table containing the patch index of each pixel
+    row_id = torch.arange(H, device=tgt_img.device) // block_h
+    col_id = torch.arange(W, device=tgt_img.device) // block_w
+    chunk_id = row_id.reshape(-1, 1) * num_split_w + col_id.reshape(1, -1)  # (H, W)
+
+    flat_idx = (chunk_id * num_bins + bin_idx).reshape(*batch_shape, H * W)
+    count = mask.reshape(*batch_shape, H * W).int()  # Masked pixels add zero counts
+    # Bin counts are bounded by H * W, so they are accumulated in int32
+    hist = torch.zeros([*batch_shape, num_chunks * num_bins], device=tgt_img.device, dtype=torch.int32).scatter_add_(
+        dim=-1, index=flat_idx, src=count)
+    hist = hist.reshape(*batch_shape, num_chunks, num_bins).float()
+
+    if normalize:
+        eps = 1e-6
+        hist = hist / (hist.sum(-1, keepdim=True) + eps)  # Normalize
+    hist = hist.reshape(*batch_shape, num_chunks, *channels)
+
+    return hist
+
+
 def histogram_sphere(colors: torch.Tensor, weights: torch.Tensor, channels: List[int] = [32, 32, 32], normalize=True) -> torch.Tensor:
     """
     Returns a color histogram of an input image
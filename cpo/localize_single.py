@@ -45,6 +45,7 @@ def localize(cfg: NamedTuple, log_dir: str, query_img_path: str, color_pcd_path:
     # Algorithm configs
     sample_rate = getattr(cfg, 'sample_rate', 1)
     top_k_candidate = getattr(cfg, 'top_k_candidate', 5)
+    trans_batch_size = getattr(cfg, 'trans_batch_size', 1)
 
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
@@ -125,7 +126,8 @@ def localize(cfg: NamedTuple, log_dir: str, query_img_path: str, color_pcd_path:
     trans = generate_trans_points(xyz, init_dict, device=img.device)
 
     input_trans, input_rot = histogram_pose_search(img, init_input_xyz, init_input_rgb, trans, rot, top_k_candidate,
-        init_dict['num_split_h'], init_dict['num_split_w'], score_map_2d_search, init_dict['sin_hist'])
+        init_dict['num_split_h'], init_dict['num_split_w'], score_map_2d_search, init_dict['sin_hist'],
+        trans_batch_size=trans_batch_size)
 
     # Pose refinement
     main_input_xyz = init_input_xyz
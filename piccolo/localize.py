@@ -52,6 +52,7 @@ def localize(cfg: NamedTuple, log_dir: str):
     sample_rate = getattr(cfg, 'sample_rate', 1)
     top_k_candidate = getattr(cfg, 'top_k_candidate', 5)
     num_intermediate = getattr(cfg, 'num_intermediate', 20)
+    rot_batch_size = getattr(cfg, 'rot_batch_size', 1)
 
     logger = PoseLogger(log_dir)
 
@@ -166,7 +167,8 @@ def localize(cfg: NamedTuple, log_dir: str):
         trans = generate_trans_points(xyz, init_dict, device=img.device)
 
         input_trans, input_rot = sampling_histogram_pose_search(img, init_input_xyz, init_input_rgb,
-            trans, rot, top_k_candidate, init_dict['num_split_h'], init_dict['num_split_w'], num_intermediate)
+            trans, rot, top_k_candidate, init_dict['num_split_h'], init_dict['num_split_w'], num_intermediate,
+            rot_batch_size=rot_batch_size)
 
         # Set image for refinement
         img = cv2.resize(orig_img, (orig_img.shape[1] // main_downsample_w, orig_img.shape[0] // main_downsample_h))
@@ -3,13 +3,10 @@ import torch.nn.functional as F
 import numpy as np
 import cv2
 from typing import Tuple, Union
-try:
-    from torch_scatter import scatter_min
-except ImportError:
-    pass
 from tqdm import tqdm
 from collections import defaultdict
 from math import ceil
+from functools import lru_cache
 import matplotlib.pyplot as plt
 from glob import glob
 from typing import Optional
@@ -17,9 +14,10 @@ import math
 from torch.nn.functional import cosine_similarity
 import os
 from scipy.ndimage import map_coordinates
-from color_utils import histogram, histogram_intersection, color_match
+from color_utils import histogram, split_histogram, color_match
 
 
+@torch.jit.script
 def cloud2idx(xyz: torch.Tensor, batched: bool = False) -> torch.Tensor:
     """
     Change 3d coordinates to image coordinates ranged in [-1, 1].
@@ -31,60 +29,47 @@ def cloud2idx(xyz: torch.Tensor, batched: bool = False) -> torch.Tensor:
     Returns:
         coord_arr: (N, 2) torch tensor containing transformed image coordinates
     """
-    if batched:
-        # first project 3d coordinates to a unit sphere and obtain vertical/horizontal angle
-
-        # vertical angle
-        theta = torch.unsqueeze(torch.atan2((torch.norm(xyz[..., :2], dim=-1)), xyz[..., 2] + 1e-6), -1)  # (B, N, 1)
-
-        # horizontal angle
-        phi = torch.atan2(xyz[..., 1:2], xyz[..., 0:1] + 1e-6)  # (B, N, 1)
-        phi += np.pi
-
-        sphere_cloud_arr = torch.cat([phi, theta], dim=-1)  # (B, N, 2)
-
-        # image coordinates ranged in [0, 1]
-        coord_arr = torch.stack([1.0 - sphere_cloud_arr[..., 0] / (np.pi * 2), sphere_cloud_arr[..., 1] / np.pi], dim=-1)
-        # Rearrange so that the range is in [-1, 1]
-        coord_arr = (2 * coord_arr - 1)  # (B, N, 2)
-
-    else:
-        # first project 3d coordinates to a unit sphere and obtain vertical/horizontal angle
+    # Both batched and non-batched inputs are handled by operating on the last dimension,
+    # and the function is scripted so that the elementwise operations below are fused
+    xyz_planes = torch.movedim(xyz, -1, 0)  # (3, N) or (3, B, N)
+    if not xyz.is_cuda:
+        # Strided inputs fall back to scalar libm calls on CPU, so make each axis contiguous to use the vectorized kernels
+        xyz_planes = xyz_planes.contiguous()
 
-        # vertical angle
-        theta = torch.unsqueeze(torch.atan2((torch.norm(xyz[:, :2], dim=-1)), xyz[:, 2] + 1e-6), 1)
+    # first project 3d coordinates to a unit sphere and obtain vertical/horizontal angle
 
-        # horizontal angle
-        phi = torch.atan2(xyz[:, 1:2], xyz[:, 0:1] + 1e-6)
-        phi += np.pi
+    # vertical angle
+    theta = torch.atan2(torch.linalg.norm(xyz_planes[:2], dim=0), xyz_planes[2] + 1e-6)
 
-        sphere_cloud_arr = torch.cat([phi, theta], dim=-1)
+    # horizontal angle
+    phi = torch.atan2(xyz_planes[1], xyz_planes[0] + 1e-6)
 
-        # image coordinates ranged in [0, 1]
-        coord_arr = torch.stack([1.0 - sphere_cloud_arr[:, 0] / (np.pi * 2), sphere_cloud_arr[:, 1] / np.pi], dim=-1)
-        # Rearrange so that the range is in [-1, 1]
-        coord_arr = (2 * coord_arr - 1)
+    # image coordinates ranged in [-1, 1], simplified from 2 * [1 - (phi + pi) / (2 * pi), theta / pi] - 1
+    coord_arr = torch.stack([-phi / math.pi, 2 * theta / math.pi - 1], dim=-1)
 
     return coord_arr
 
 
-def inv_cloud2idx(coord_arr: torch.Tensor):
+@torch.jit.script
+def inv_cloud2idx(coord_arr: torch.Tensor) -> torch.Tensor:
     # Inversion of cloud2idx: given a (N, 2) coord_arr, returns a set of (N, 3) 3D points on a sphere.
-    sphere_cloud_arr = (coord_arr + 1.) / 2.
-    sphere_cloud_arr[:, 0] = (1.0 - sphere_cloud_arr[:, 0]) * (2 * np.pi)
-    sphere_cloud_arr[:, 1] = np.pi * sphere_cloud_arr[:, 1]  # Contains [phi, theta] of sphere
+    # Scripted so that the trigonometric terms below are fused into a single elementwise kernel
+    coord_planes = coord_arr.t()  # (2, N)
+    if not coord_arr.is_cuda:
+        # Contiguous inputs let sin / cos use the vectorized kernels on CPU
+        coord_planes = coord_planes.contiguous()
 
-    sphere_cloud_arr[:, 0] -= np.pi  # Subtraction to accomodate for cloud2idx
+    phi = (1.0 - (coord_planes[0] + 1.) / 2.) * (2 * math.pi) - math.pi  # Subtraction to accomodate for cloud2idx
+    theta = (coord_planes[1] + 1.) / 2. * math.pi
 
-    sphere_xyz = torch.zeros(sphere_cloud_arr.shape[0], 3, device=coord_arr.device)
-    sphere_xyz[:, 0] = torch.sin(sphere_cloud_arr[:, 1]) * torch.cos(sphere_cloud_arr[:, 0])
-    sphere_xyz[:, 1] = torch.sin(sphere_cloud_arr[:, 1]) * torch.sin(sphere_cloud_arr[:, 0])
-    sphere_xyz[:, 2] = torch.cos(sphere_cloud_arr[:, 1])
+    sin_theta = torch.sin(theta)
+    sphere_xyz = torch.stack([sin_theta * torch.cos(phi), sin_theta * torch.sin(phi), torch.cos(theta)], dim=-1)
 
     return sphere_xyz
 
 
-def sample_from_img(img: torch.Tensor, coord_arr: torch.Tensor, padding='zeros', mode='bilinear', batched=False) -> torch.Tensor:
+def sample_from_img(img: torch.Tensor, coord_arr: torch.Tensor, padding='zeros', mode='bilinear', batched=False,
+        dtype: Optional[torch.dtype] = None) -> torch.Tensor:
     """
     Image sampling function
     Use coord_arr as a grid for sampling from img
@@ -95,33 +80,26 @@ def sample_from_img(img: torch.Tensor, coord_arr: torch.Tensor, padding='zeros',
         padding: Padding mode to use for grid_sample
         mode: How to sample from grid
         batched: If True, assumes an additional batch dimension for coord_arr
+        dtype: If provided, img and coord_arr are cast to dtype (e.g. torch.float16 or torch.bfloat16 on CUDA) before sampling
 
     Returns:
         sample_rgb: (N, 3) torch tensor containing sampled RGB values
     """
-    if batched:
-        img = img.permute(2, 0, 1)
-        img = torch.unsqueeze(img, 0)
-
-        # sampling from img
-        sample_arr = coord_arr.reshape(coord_arr.shape[0], coord_arr.shape[1], 1, 2)
-        sample_arr = torch.clip(sample_arr, min=-0.99, max=0.99)
-        sample_rgb = F.grid_sample(img.expand(coord_arr.shape[0], -1, -1, -1), sample_arr, mode=mode, align_corners=False, padding_mode=padding)
-
-        sample_rgb = torch.squeeze(sample_rgb)  # (B, 3, N)
-        sample_rgb = torch.transpose(sample_rgb, 1, 2)  # (B, N, 3)  
+    if dtype is not None:
+        img = img.to(dtype)
+        coord_arr = coord_arr.to(dtype)
 
-    else:
-        img = img.permute(2, 0, 1)
-        img = torch.unsqueeze(img, 0)
+    # Permuting a contiguous (H, W, 3) image gives a channels-last view, so no copy is made here
+    img = img.permute(2, 0, 1)
+    img = torch.unsqueeze(img, 0)
 
-        # sampling from img
-        sample_arr = coord_arr.reshape(1, -1, 1, 2)
-        sample_arr = torch.clip(sample_arr, min=-0.99, max=0.99)
-        sample_rgb = F.grid_sample(img, sample_arr, mode=mode, align_corners=False, padding_mode=padding)
+    # sampling from img, where batched coordinates are flattened so that all batches share a single image instead of an expanded one
+    sample_arr = coord_arr.reshape(1, -1, 1, 2)
+    sample_arr = torch.clip(sample_arr, min=-0.99, max=0.99)
+    sample_rgb = F.grid_sample(img, sample_arr, mode=mode, align_corners=False, padding_mode=padding)  # (1, 3, N, 1) or (1, 3, B * N, 1)
 
-        sample_rgb = torch.squeeze(torch.squeeze(sample_rgb, 0), 2)
-        sample_rgb = torch.transpose(sample_rgb, 0, 1)
+    sample_rgb = sample_rgb[0, :, :, 0].t()
+    sample_rgb = sample_rgb.reshape(*coord_arr.shape[:-1], -1)  # (N, 3) or (B, N, 3)
 
     return sample_rgb
 
@@ -132,24 +110,24 @@ def warp_from_img(img: torch.Tensor, coord_arr: torch.Tensor, padding='zeros', m
     Use coord_arr as a grid for warping from img
 
     Args:
-        img: (H, W, C) torch tensor containing image RGB values
-        coord_arr: (H, W, 2) torch tensor containing image coordinates, ranged in [-1, 1], converted from 3d coordinates
+        img: (H, W, C) or (B, H, W, C) torch tensor containing image RGB values
+        coord_arr: (H, W, 2) or (B, H, W, 2) torch tensor containing image coordinates, ranged in [-1, 1], converted from 3d coordinates
         padding: Padding mode to use for grid_sample
         mode: How to sample from grid
 
     Returns:
-        sample_rgb: (H, W, C) torch tensor containing sampled RGB values
+        sample_rgb: (H, W, C) or (B, H, W, C) torch tensor containing sampled RGB values
     """
 
-    img = img.permute(2, 0, 1)  # (C, H, W)
-    img = torch.unsqueeze(img, 0)  # (1, C, H, W)
-
-    # sampling from img
-    sample_arr = coord_arr.unsqueeze(0)  # (1, H, W, 2)
+    # sampling from img, where a batch of grids is sampled from a single image or from a batch of images in a single call
+    sample_arr = coord_arr.reshape(-1, *coord_arr.shape[-3:])  # (B, H, W, 2)
     sample_arr = torch.clip(sample_arr, min=-0.99, max=0.99)
-    sample_rgb = F.grid_sample(img, sample_arr, align_corners=False, padding_mode=padding, mode=mode)  # (1, C, H, W)
 
-    sample_rgb = sample_rgb.squeeze(0).permute(1, 2, 0)  # (H, W, C)
+    img = img.movedim(-1, -3)  # (C, H, W) or (B, C, H, W)
+    img = img.expand(sample_arr.shape[0], *img.shape[-3:])  # (B, C, H, W)
+    sample_rgb = F.grid_sample(img, sample_arr, align_corners=False, padding_mode=padding, mode=mode)  # (B, C, H, W)
+
+    sample_rgb = sample_rgb.permute(0, 2, 3, 1).reshape(*coord_arr.shape[:-1], -1)  # (H, W, C) or (B, H, W, C)
 
     return sample_rgb
 
@@ -167,12 +145,13 @@ def ij2coord(ij_values, resolution):
 
 
 def make_pano(xyz: torch.Tensor, rgb: torch.Tensor, resolution: Tuple[int, int] = (200, 400), 
-        return_torch: bool = False, return_coord: bool = False, return_norm_coord: bool = False, default_white=False) -> Union[torch.Tensor, np.array]:
+        return_torch: bool = False, return_coord: bool = False, return_norm_coord: bool = False, default_white=False,
+        dtype: torch.dtype = torch.float) -> Union[torch.Tensor, np.array]:
     """
     Make panorama image from xyz and rgb tensors
 
     Args:
-        xyz: (N, 3) torch tensor containing xyz coordinates
+        xyz: (N, 3) or (B, N, 3) torch tensor containing xyz coordinates, where batched point clouds share rgb
         rgb: (N, 3) torch tensor containing rgb values, ranged in [0, 1]
         resolution: Tuple size of 2, returning panorama image of size resolution
         return_torch: if True, return image as torch.Tensor
@@ -180,77 +159,82 @@ def make_pano(xyz: torch.Tensor, rgb: torch.Tensor, resolution: Tuple[int, int]
         return_coord: If True, return coordinate in long format
         return_norm_coord: If True, return coordinate in normalized float format
         default_white: If True, defaults the color values to white
+        dtype: Data type of the panorama image, where torch.bfloat16 halves the memory footprint at the cost of color precision
 
     Returns:
-        image: (H, W, 3) torch.Tensor or numpy.array
+        image: (H, W, 3) or (B, H, W, 3) torch.Tensor or numpy.array
     """
 
     with torch.no_grad():
 
         # project farther points first
         dist = torch.norm(xyz, dim=-1)
-        mod_idx = torch.argsort(dist)
-        mod_idx = torch.flip(mod_idx, dims=[0])
-        mod_xyz = xyz.clone().detach()[mod_idx]
-        mod_rgb = rgb.clone().detach()[mod_idx]
+        mod_idx = torch.argsort(dist, dim=-1, descending=True)
+        mod_xyz = torch.take_along_dim(xyz, mod_idx.unsqueeze(-1), dim=-2)  # Indexing already makes a copy, which is detached under no_grad
+        mod_rgb = rgb[mod_idx]
 
         orig_coord_idx = cloud2idx(mod_xyz)
         coord_idx = (orig_coord_idx + 1.0) / 2.0
-        # coord_idx[:, 0] is x coordinate, coord_idx[:, 1] is y coordinate
-        coord_idx[:, 0] *= (resolution[1] - 1)
-        coord_idx[:, 1] *= (resolution[0] - 1)
+        # coord_idx[..., 0] is x coordinate, coord_idx[..., 1] is y coordinate
+        coord_idx[..., 0] *= (resolution[1] - 1)
+        coord_idx[..., 1] *= (resolution[0] - 1)
 
         coord_idx = torch.flip(coord_idx, [-1])
         coord_idx = coord_idx.long()
-        save_coord_idx = coord_idx.clone().detach()
-        coord_idx = tuple(coord_idx.t())
+        save_coord_idx = coord_idx  # coord_idx is rebound below, so no copy is needed
 
+        batch_shape = xyz.shape[:-2]
         if default_white:
-            image = torch.ones([resolution[0], resolution[1], 3], dtype=torch.float, device=xyz.device)
+            image = torch.ones([*batch_shape, resolution[0], resolution[1], 3], dtype=dtype, device=xyz.device)
         else:
-            image = torch.zeros([resolution[0], resolution[1], 3], dtype=torch.float, device=xyz.device)
+            image = torch.zeros([*batch_shape, resolution[0], resolution[1], 3], dtype=dtype, device=xyz.device)
 
         # color the image
-        # pad by 1
-        temp = torch.ones_like(coord_idx[0], device=xyz.device)
-        coord_idx1 = (torch.clamp(coord_idx[0] + temp, max=resolution[0] - 1),
-                      torch.clamp(coord_idx[1] + temp, max=resolution[1] - 1))
-        coord_idx2 = (torch.clamp(coord_idx[0] + temp, max=resolution[0] - 1),
-                      coord_idx[1])
-        coord_idx3 = (torch.clamp(coord_idx[0] + temp, max=resolution[0] - 1),
-                      torch.clamp(coord_idx[1] - temp, min=0))
-        coord_idx4 = (torch.clamp(coord_idx[0] - temp, min=0),
-                      torch.clamp(coord_idx[1] + temp, max=resolution[1] - 1))
-        coord_idx5 = (torch.clamp(coord_idx[0] - temp, min=0),
-                      coord_idx[1])
-        coord_idx6 = (torch.clamp(coord_idx[0] - temp, min=0),
-                      torch.clamp(coord_idx[1] - temp, min=0))
-        coord_idx7 = (coord_idx[0],
-                      torch.clamp(coord_idx[1] + temp, max=resolution[1] - 1))
-        coord_idx8 = (coord_idx[0],
-                      torch.clamp(coord_idx[1] - temp, min=0))
-
-        image.index_put_(coord_idx8, mod_rgb, accumulate=False)
-        image.index_put_(coord_idx7, mod_rgb, accumulate=False)
-        image.index_put_(coord_idx6, mod_rgb, accumulate=False)
-        image.index_put_(coord_idx5, mod_rgb, accumulate=False)
-        image.index_put_(coord_idx4, mod_rgb, accumulate=False)
-        image.index_put_(coord_idx3, mod_rgb, accumulate=False)
-        image.index_put_(coord_idx2, mod_rgb, accumulate=False)
-        image.index_put_(coord_idx1, mod_rgb, accumulate=False)
-        image.index_put_(coord_idx, mod_rgb, accumulate=False)
-
-        image = image * 255
+        # pad by 1, where neighbors are ordered so that the center layer takes precedence
+        coord_i, coord_j = coord_idx.unbind(-1)
+        coord_i_minus, coord_i_plus = torch.clamp(coord_i - 1, min=0), torch.clamp(coord_i + 1, max=resolution[0] - 1)
+        coord_j_minus, coord_j_plus = torch.clamp(coord_j - 1, min=0), torch.clamp(coord_j + 1, max=resolution[1] - 1)
+
+        pad_coord_i = torch.stack([coord_i, coord_i, coord_i_minus, coord_i_minus, coord_i_minus,
+            coord_i_plus, coord_i_plus, coord_i_plus, coord_i])
+        pad_coord_j = torch.stack([coord_j_minus, coord_j_plus, coord_j_minus, coord_j, coord_j_plus,
+            coord_j_minus, coord_j, coord_j_plus, coord_j])
+        pad_pixel_idx = pad_coord_i * resolution[1] + pad_coord_j  # (9, N) or (9, B, N)
+        num_points = mod_idx.shape[-1]
+        if len(batch_shape) != 0:
+            # Offset pixels of each panorama in the batch
+            pad_pixel_idx += (torch.arange(batch_shape[0], device=xyz.device) * resolution[0] * resolution[1]).unsqueeze(-1)
+
+        # Resolve which point colors each pixel, as if the layers were written one after another with the center layer last,
+        # and points within a layer from far to near. Since duplicate indices in index_put_ have no defined write order,
+        # the write priority (layer * N + rank from far to near) is maximized per pixel explicitly
+        layer_idx = torch.arange(9, device=xyz.device).reshape(9, *([1] * (len(batch_shape) + 1)))
+        priority = (layer_idx * num_points + torch.arange(num_points, device=xyz.device)).expand(pad_pixel_idx.shape)
+        pixel_priority = torch.full([image.numel() // 3], -1, dtype=torch.long, device=xyz.device)
+        pixel_priority = pixel_priority.scatter_reduce(0, pad_pixel_idx.reshape(-1), priority.reshape(-1), reduce='amax')
+
+        # Gather colors of the winning points, where the batch of each pixel is recovered from its flattened index
+        pixel_point_idx = pixel_priority.clamp(min=0) % num_points
+        if len(batch_shape) != 0:
+            pixel_point_idx += torch.arange(image.numel() // 3, device=xyz.device) // (resolution[0] * resolution[1]) * num_points
+        pixel_rgb = mod_rgb.reshape(-1, 3).to(dtype)[pixel_point_idx]
+        image = torch.where((pixel_priority >= 0).unsqueeze(-1), pixel_rgb, image.view(-1, 3)).reshape(image.shape)
+
+        image.mul_(255)
 
         if not return_torch:
-            image = image.cpu().numpy().astype(np.uint8)
+            # Cast on device so that only one byte per channel is copied to host
+            image = image.clamp_(0, 255).to(torch.uint8).cpu().numpy()
+    if return_coord or return_norm_coord:
+        # mod_idx is a permutation, so it is inverted with a single scatter instead of another argsort
+        inv_mod_idx = torch.empty_like(mod_idx)
+        inv_mod_idx.scatter_(-1, mod_idx, torch.arange(mod_idx.shape[-1], device=mod_idx.device).expand_as(mod_idx))
+
     if return_coord:
         # mod_idx is in (i, j) format, not (x, y) format
-        inv_mod_idx = torch.argsort(mod_idx)
-        return image, save_coord_idx[inv_mod_idx]
+        return image, torch.take_along_dim(save_coord_idx, inv_mod_idx.unsqueeze(-1), dim=-2)
     elif return_norm_coord:
-        inv_mod_idx = torch.argsort(mod_idx)
-        return image, orig_coord_idx[inv_mod_idx]
+        return image, torch.take_along_dim(orig_coord_idx, inv_mod_idx.unsqueeze(-1), dim=-2)
     else:
         return image
 
@@ -260,7 +244,7 @@ def quantile(x: torch.Tensor, q: float) -> Tuple[Union[int, float], Union[int, f
     Obtain q quantile value and (1 - q) quantile value from x
 
     Args:
-        x: 1-dim torch tensor
+        x: (N, ) torch tensor, or (N, C) torch tensor in which case quantiles are computed per column
         q: q value for quantile
 
     Returns:
@@ -269,12 +253,12 @@ def quantile(x: torch.Tensor, q: float) -> Tuple[Union[int, float], Union[int, f
     """
 
     with torch.no_grad():
-        inds = torch.argsort(x)
-        val_1 = int(len(x) * q)
-        val_2 = int(len(x) * (1 - q))
+        # Selection instead of a full sort, note that k is 1-indexed in kthvalue
+        k_1 = min(int(len(x) * q) + 1, len(x))
+        k_2 = min(int(len(x) * (1 - q)) + 1, len(x))
 
-        result_1 = x[inds[val_1]]
-        result_2 = x[inds[val_2]]
+        result_1 = torch.kthvalue(x, k_1, dim=0).values
+        result_2 = torch.kthvalue(x, k_2, dim=0).values
 
     return result_1, result_2
 
@@ -294,9 +278,9 @@ def out_of_room(xyz: torch.Tensor, trans: torch.Tensor, out_quantile: float = 0.
 
     with torch.no_grad():
         # rejecting outliers
-        x_min, x_max = quantile(xyz[:, 0], out_quantile)
-        y_min, y_max = quantile(xyz[:, 1], out_quantile)
-        z_min, z_max = quantile(xyz[:, 2], out_quantile)
+        xyz_min, xyz_max = quantile(xyz, out_quantile)
+        x_min, y_min, z_min = xyz_min
+        x_max, y_max, z_max = xyz_max
 
         if x_min < trans[0][0] < x_max and y_min < trans[1][0] < y_max and z_min < trans[2][0] < z_max:
             return False
@@ -310,9 +294,9 @@ def get_bound(xyz: torch.Tensor, cfg, return_brute=False):
 
     with torch.no_grad():
         # rejecting outliers
-        x_min, x_max = quantile(xyz[:, 0], out_quantile)
-        y_min, y_max = quantile(xyz[:, 1], out_quantile)
-        z_min, z_max = quantile(xyz[:, 2], out_quantile)
+        xyz_min, xyz_max = quantile(xyz, out_quantile)
+        x_min, y_min, z_min = xyz_min
+        x_max, y_max, z_max = xyz_max
 
     max_yaw = getattr(cfg, 'max_yaw', 2 * np.pi)
     min_yaw = getattr(cfg, 'min_yaw', 0)
@@ -344,8 +328,8 @@ def adaptive_trans_num(xyz: torch.Tensor, max_trans_num: int, xy_only: bool = Fa
         num_start_trans_z: number of z coordinate translation candidates, only returned when xy_only is False
     """
 
-    xyz_max = torch.quantile(xyz, dim=0, q=0.90)
-    xyz_min = torch.quantile(xyz, dim=0, q=0.10)
+    # Both quantiles are taken from a single sort of xyz
+    xyz_min, xyz_max = torch.quantile(xyz, torch.tensor([0.10, 0.90], dtype=xyz.dtype, device=xyz.device), dim=0)
     xyz_length = xyz_max - xyz_min
 
     if xy_only:
@@ -388,25 +372,29 @@ def generate_rot_points(init_dict=None, device='cpu'):
 
     else:
         # Perform 3 DoF initialization
-        rot_coords = torch.meshgrid(torch.arange(init_dict['num_yaw'], device=device).float() / init_dict['num_yaw'],
+        rot_arr = torch.cartesian_prod(torch.arange(init_dict['num_yaw'], device=device).float() / init_dict['num_yaw'],
             torch.arange(init_dict['num_pitch'], device=device).float() / init_dict['num_pitch'],
             torch.arange(init_dict['num_roll'], device=device).float() / init_dict['num_roll'])
 
-        rot_arr = torch.stack([rot_coords[0].reshape(-1), rot_coords[1].reshape(-1), rot_coords[2].reshape(-1)], dim=0).t()
-
         rot_arr[:, 0] = (rot_arr[:, 0] * (init_dict['max_yaw'] - init_dict['min_yaw'])) + init_dict['min_yaw']
         rot_arr[:, 1] = (rot_arr[:, 1] * (init_dict['max_pitch'] - init_dict['min_pitch'])) + init_dict['min_pitch']
         rot_arr[:, 2] = (rot_arr[:, 2] * (init_dict['max_roll'] - init_dict['min_roll'])) + init_dict['min_roll']
 
         # Initialize grid sample locations
-        grid_list = [compute_sampling_grid(ypr, init_dict['num_yaw'], init_dict['num_pitch']) for ypr in rot_arr]
+        grid_arr = compute_sampling_grid(rot_arr, init_dict['num_yaw'], init_dict['num_pitch'])  # (N, H, W, 2)
 
         # Filter out overlapping rotations
         round_digit = 3
-        rot_list = [str(np.around(grid.cpu().numpy(), round_digit)) for grid in grid_list]
-        valid_rot_idx = [rot_list.index(rot_mtx) for rot_mtx in sorted(set(rot_list))]  # sorted added to make things deterministic
-        rot_arr = torch.stack([rot_arr[idx] for idx in valid_rot_idx], dim=0)
-        
+        grid_key = torch.round(grid_arr * 10 ** round_digit).int().reshape(len(rot_arr), -1)
+
+        # Keep the first rotation within each group of overlapping rotations
+        _, valid_rot_idx = np.unique(grid_key.cpu().numpy(), axis=0, return_index=True)
+
+        # Order groups by the string of their rounded grids as before, since downstream top-k and tie-breaking follow this order
+        grid_np = grid_arr.cpu().numpy()
+        valid_rot_idx = sorted(valid_rot_idx.tolist(), key=lambda idx: str(np.around(grid_np[idx], round_digit)))
+        rot_arr = rot_arr[torch.tensor(valid_rot_idx, device=rot_arr.device)]
+
         # Put identity at front
         zero_idx = torch.where(rot_arr.sum(-1) == 0.)[0].item()
         rot_arr[[0, zero_idx]] = rot_arr[[zero_idx, 0]]
@@ -460,8 +448,7 @@ def generate_trans_points(xyz, init_dict=None, device='cpu'):
             trans_arr = torch.zeros(num_trans_x * num_trans_y, 3, device=device)
 
             x_points, y_points = get_starting_points(num_trans_x, num_trans_y)
-            trans_coords = torch.meshgrid(x_points, y_points)
-            trans_arr[:, :2] = torch.stack([trans_coords[0].reshape(-1), trans_coords[1].reshape(-1)], dim=0).t()
+            trans_arr[:, :2] = torch.cartesian_prod(x_points, y_points)
             if init_dict['z_prior'] is not None:
                 trans_arr[:, 2] = init_dict['z_prior']
             else:
@@ -480,20 +467,18 @@ def generate_trans_points(xyz, init_dict=None, device='cpu'):
             num_trans_x, num_trans_y, num_trans_z = adaptive_trans_num(xyz, num_grid_points, xy_only=False)
             x_points, y_points, z_points = get_starting_points(num_trans_x, num_trans_y, num_trans_z)
 
-            trans_coords = torch.meshgrid(x_points, y_points, z_points)
-            grid_trans = torch.stack([trans_coords[0].reshape(-1), trans_coords[1].reshape(-1), trans_coords[2].reshape(-1)], dim=0).t()
+            grid_trans = torch.cartesian_prod(x_points, y_points, z_points)
 
             # Merge octree and grid
-            mutual_dist = (grid_trans.unsqueeze(1) - octree_trans.unsqueeze(0)).norm(dim=-1)  # (Num of grid, num of octree)
-            valid_idx = mutual_dist.min(dim=-1).values > 1.5  # Choose grid points that are far away from octree points
+            mutual_dist = torch.cdist(grid_trans, octree_trans)  # (Num of grid, num of octree)
+            valid_idx = mutual_dist.amin(dim=-1) > 1.5  # Choose grid points that are far away from octree points
             trans_arr = torch.cat([grid_trans[valid_idx], octree_trans], dim=0)
         elif init_dict['trans_init_mode'] == 'quantile':
             num_trans = init_dict['num_trans']
             num_trans_x, num_trans_y, num_trans_z = adaptive_trans_num(xyz, num_trans, xy_only=False)
             x_points, y_points, z_points = get_starting_points(num_trans_x, num_trans_y, num_trans_z)
 
-            trans_coords = torch.meshgrid(x_points, y_points, z_points)
-            trans_arr = torch.stack([trans_coords[0].reshape(-1), trans_coords[1].reshape(-1), trans_coords[2].reshape(-1)], dim=0).t()
+            trans_arr = torch.cartesian_prod(x_points, y_points, z_points)
         elif init_dict['trans_init_mode'] == 'voxel':
             voxel_size = init_dict['voxel_size']
             quantile_thres = min(init_dict['quantile_thres'], 1 - init_dict['quantile_thres']) 
@@ -505,8 +490,7 @@ def generate_trans_points(xyz, init_dict=None, device='cpu'):
             x_points = torch.linspace(xyz_min[0], xyz_max[0], num_x, device=xyz.device)
             y_points = torch.linspace(xyz_min[1], xyz_max[1], num_y, device=xyz.device)
             z_points = torch.linspace(xyz_min[2], xyz_max[2], num_z, device=xyz.device)
-            trans_coords = torch.meshgrid(x_points, y_points, z_points)
-            trans_arr = torch.stack([trans_coords[0].reshape(-1), trans_coords[1].reshape(-1), trans_coords[2].reshape(-1)], dim=0).t()
+            trans_arr = torch.cartesian_prod(x_points, y_points, z_points)
         else:
             if init_dict['benchmark_grid'] and not init_dict['is_inlier_dict']:
                 tot_trans_count = len(generate_octree(xyz, device, nmin))
@@ -515,8 +499,7 @@ def generate_trans_points(xyz, init_dict=None, device='cpu'):
             num_trans_x, num_trans_y, num_trans_z = adaptive_trans_num(xyz, tot_trans_count, xy_only=False)
             x_points, y_points, z_points = get_starting_points(num_trans_x, num_trans_y, num_trans_z)
 
-            trans_coords = torch.meshgrid(x_points, y_points, z_points)
-            trans_arr = torch.stack([trans_coords[0].reshape(-1), trans_coords[1].reshape(-1), trans_coords[2].reshape(-1)], dim=0).t()
+            trans_arr = torch.cartesian_prod(x_points, y_points, z_points)
 
     return trans_arr
 
@@ -539,78 +522,44 @@ def generate_trans_center(trans_tensor, range, num_split):
     y_points = torch.linspace(start=min_y, end=max_y, steps=num_split, device=trans_tensor.device)
     z_points = torch.linspace(start=min_z, end=max_z, steps=num_split, device=trans_tensor.device)
 
-    trans_coords = torch.meshgrid(x_points, y_points, z_points)
-    trans_arr = torch.stack([trans_coords[0].reshape(-1), trans_coords[1].reshape(-1), trans_coords[2].reshape(-1)], dim=0).t()
+    trans_arr = torch.cartesian_prod(x_points, y_points, z_points)
 
     return trans_arr
 
 
 def rot_from_ypr(ypr_array):
-    def _ypr2mtx(ypr):
-        # ypr is assumed to have a shape of [3, ]
-        yaw, pitch, roll = ypr
-        yaw = yaw.unsqueeze(0)
-        pitch = pitch.unsqueeze(0)
-        roll = roll.unsqueeze(0)
-
-        tensor_0 = torch.zeros(1, device=yaw.device)
-        tensor_1 = torch.ones(1, device=yaw.device)
-
-        RX = torch.stack([
-                        torch.stack([tensor_1, tensor_0, tensor_0]),
-                        torch.stack([tensor_0, torch.cos(roll), -torch.sin(roll)]),
-                        torch.stack([tensor_0, torch.sin(roll), torch.cos(roll)])]).reshape(3, 3)
-
-        RY = torch.stack([
-                        torch.stack([torch.cos(pitch), tensor_0, torch.sin(pitch)]),
-                        torch.stack([tensor_0, tensor_1, tensor_0]),
-                        torch.stack([-torch.sin(pitch), tensor_0, torch.cos(pitch)])]).reshape(3, 3)
-
-        RZ = torch.stack([
-                        torch.stack([torch.cos(yaw), -torch.sin(yaw), tensor_0]),
-                        torch.stack([torch.sin(yaw), torch.cos(yaw), tensor_0]),
-                        torch.stack([tensor_0, tensor_0, tensor_1])]).reshape(3, 3)
-
-        R = torch.mm(RZ, RY)
-        R = torch.mm(R, RX)
-
-        return R
-    
-    if len(ypr_array.shape) == 1:
-        return _ypr2mtx(ypr_array)
-    else:
-        tot_mtx = []
-        for ypr in ypr_array:
-            tot_mtx.append(_ypr2mtx(ypr))
-        return torch.stack(tot_mtx)
+    # ypr_array is assumed to have a shape of [3, ] or [B, 3]
+    # Entries of R = RZ(yaw) @ RY(pitch) @ RX(roll) are written out in closed form so that the whole batch is built at once
+    yaw, pitch, roll = ypr_array.reshape(-1, 3).unbind(-1)
+    cos_y, sin_y = torch.cos(yaw), torch.sin(yaw)
+    cos_p, sin_p = torch.cos(pitch), torch.sin(pitch)
+    cos_r, sin_r = torch.cos(roll), torch.sin(roll)
+
+    R = torch.stack([
+        cos_y * cos_p, cos_y * sin_p * sin_r - sin_y * cos_r, cos_y * sin_p * cos_r + sin_y * sin_r,
+        sin_y * cos_p, sin_y * sin_p * sin_r + cos_y * cos_r, sin_y * sin_p * cos_r - cos_y * sin_r,
+        -sin_p, cos_p * sin_r, cos_p * cos_r], dim=-1)
+
+    return R.reshape(*ypr_array.shape[:-1], 3, 3)
 
 
 def ypr_from_rot(rot_mtx):
-    def _mtx2ypr(in_mtx):
-        # in_mtx is assumed to have a shape of [3, 3]
-        yaw = torch.atan2(in_mtx[1, 0], in_mtx[0, 0] + 1e-6)
-        pitch = torch.arcsin(-in_mtx[2, 0])
-        roll = torch.atan2(in_mtx[2, 1], in_mtx[2, 2])
-
-        ypr = torch.tensor([yaw, pitch, roll], device=in_mtx.device)
-        return ypr
-    
-    if len(rot_mtx.shape) == 2:
-        return _mtx2ypr(rot_mtx)
-    else:
-        tot_mtx = []
-        for mtx in rot_mtx:
-            tot_mtx.append(_mtx2ypr(mtx))
-        return torch.stack(tot_mtx)
+    # rot_mtx is assumed to have a shape of [3, 3] or [B, 3, 3]
+    yaw = torch.atan2(rot_mtx[..., 1, 0], rot_mtx[..., 0, 0] + 1e-6)
+    pitch = torch.arcsin(-rot_mtx[..., 2, 0])
+    roll = torch.atan2(rot_mtx[..., 2, 1], rot_mtx[..., 2, 2])
+
+    # Detach so that the output can be used as a fresh optimization variable, as with torch.tensor
+    ypr = torch.stack([yaw, pitch, roll], dim=-1).detach()
+    return ypr
 
 
 def reshape_img_tensor(img: torch.Tensor, size: Tuple):
-    # Note that size is (X, Y)
-    cv_img = (img.cpu().numpy() * 255).astype(np.uint8)
-    cv_img = cv2.resize(cv_img, size)
-    cv_img = cv_img / 255.
+    # Note that size is (X, Y), and resizing is done on img.device without quantizing to uint8
+    resize_img = img.float().permute(2, 0, 1).unsqueeze(0)  # (1, C, H, W)
+    resize_img = F.interpolate(resize_img, size=(size[1], size[0]), mode='bilinear', align_corners=False)
 
-    return torch.from_numpy(cv_img).float().to(img.device)
+    return resize_img.squeeze(0).permute(1, 2, 0).contiguous()
 
 
 def debug_visualize(tgt_tensor):
@@ -673,7 +622,63 @@ def debug_visualize(tgt_tensor):
         plt.show()
 
 
+@torch.jit.script
+def octree_encode(point: torch.Tensor, point_length: torch.Tensor, adaptive_nmax: torch.Tensor, valid_axis: torch.Tensor,
+        axis_rank: torch.Tensor, bit_depth: torch.Tensor) -> torch.Tensor:
+    # Integer cell index of each point along each axis, at the finest depth of that axis
+    num_cells = torch.pow(2, adaptive_nmax)
+    cell_idx = torch.floor((point + point_length) * num_cells / (2 * point_length)).long()
+    cell_idx = torch.min(cell_idx.clamp(min=0), num_cells - 1)
+
+    # The code at each depth packs the bits of the valid axes at that depth, in the order of valid axes
+    bits = (cell_idx.unsqueeze(1) >> bit_depth.clamp(min=0)) & 1
+    code = ((bits * valid_axis) << axis_rank).sum(-1)
+
+    # Codes of all depths are packed into one key with 3 bits per depth, where shallower depths are more significant
+    nmax = valid_axis.shape[0]
+    key_shift = 3 * (nmax - 1 - torch.arange(nmax, device=point.device))
+
+    return (code << key_shift).sum(-1)
+
+
+@torch.jit.script
+def octree_unpack(code_key: torch.Tensor, nmax: int) -> torch.Tensor:
+    # Split packed keys into (N, nmax) codes of each depth
+    key_shift = 3 * (nmax - 1 - torch.arange(nmax, device=code_key.device))
+
+    return (code_key.unsqueeze(-1) >> key_shift) & 7
+
+
+@torch.jit.script
+def octree_code2location(code: torch.Tensor, valid_axis: torch.Tensor, axis_rank: torch.Tensor) -> torch.Tensor:
+    # Signed offsets of the nodes summed along the path from the root, decoded for all depths at once
+    nmax = code.shape[1]
+
+    bits = (code.unsqueeze(-1) >> axis_rank) & 1
+    depth_scale = torch.pow(2, nmax - torch.arange(nmax, device=code.device)).unsqueeze(-1)
+    loc = depth_scale * (2 * bits - 1) * valid_axis * (code != -1).unsqueeze(-1)
+
+    return torch.cumsum(loc, dim=1)
+
+
+@torch.jit.script
+def octree_code2coords(code: torch.Tensor, scaler: torch.Tensor, valid_axis: torch.Tensor, axis_rank: torch.Tensor,
+        bit_depth: torch.Tensor) -> torch.Tensor:
+    # Cell centers from the signed half-cell offsets of all depths, where merged depths (-1) are skipped
+    bits = (code.unsqueeze(-1) >> axis_rank) & 1
+    loc = (2 * bits - 1) * (valid_axis & (code != -1).unsqueeze(-1))
+    depth_scale = torch.pow(2.0, bit_depth.float())
+
+    return (loc * depth_scale).sum(1) / scaler
+
+
+@torch.no_grad()
 def generate_octree(xyz, device, nmin=2):
+    # The octree is built from many small indexing operations whose launch and sync overhead dominates on GPU,
+    # hence the build runs on CPU and only the resulting coordinates are moved to device
+    out_device = device
+    device = torch.device('cpu')
+    xyz = xyz.to(device)
 
     xyz_min = torch.min(xyz, dim=0)[0]
     xyz_max = torch.max(xyz, dim=0)[0]
@@ -695,43 +700,25 @@ def generate_octree(xyz, device, nmin=2):
     nmax = adaptive_nmax.max().item()
     nmed = adaptive_nmax.median().item()
 
-
-    def check_location(point, depth, plane):
-        valid_axis = depth < adaptive_nmax
-
-        location = torch.zeros((len(point)), dtype=torch.long).to(device)
-        for count, i in enumerate(torch.nonzero(valid_axis, as_tuple=False).reshape(-1)):
-            location[point[:, i] >= plane[:, i]] += (2 ** count)
-
-        return location
-
-
-    def update_planes(code, depth, plane):
-        res = code[:, depth]
-
-        valid_axis = depth < adaptive_nmax
-        loc = torch.zeros((len(res), valid_axis.sum())).to(device)
-
-        for i in range(valid_axis.sum()):
-            if i == 0:
-                loc[:, i] = (res % 4) % 2
-            elif i == 1:
-                loc[:, i] = (res % 4) // 2
-            else:
-                loc[:, i] = res // 4
-        loc = loc * 2 - 1
-
-        plane[:, valid_axis] += loc * (2 ** (adaptive_nmax[valid_axis] - depth - 1)) / scaler[valid_axis]
-
-        return plane
+    # Per-depth tables of the valid axes, the bit of each axis in the code, and the remaining depth of each axis
+    depths = torch.arange(nmax, device=device).unsqueeze(-1)
+    valid_axis = depths < adaptive_nmax
+    axis_rank = (torch.cumsum(valid_axis.long(), dim=-1) - 1).clamp(min=0)
+    bit_depth = adaptive_nmax - depths - 1
 
 
     def merge_code(code):
 
         merged_code = code.clone()
 
+        # code is sorted and merging only modifies columns from j onwards, so the groups sharing the first j columns
+        # start wherever the first column differing from the previous row is less than j
+        first_diff = torch.zeros(len(code), dtype=torch.long, device=device)
+        first_diff[1:] = (code[1:] != code[:-1]).long().argmax(dim=1)
+
         for i, j in enumerate(range(nmax - 1, 0, -1)):
-            output, inverse_inds, counts = torch.unique_consecutive(merged_code[:, :j], True, True, dim=0)
+            inverse_inds = torch.cumsum(first_diff < j, dim=0) - 1
+            counts = torch.bincount(inverse_inds)
             if j < nmin:
                 merge_count = 2 ** (nmax - nmed) * 4 ** (nmed - nmin) * 8 ** (i + nmin - nmax + 1)
             elif j < nmed:
@@ -742,105 +729,61 @@ def generate_octree(xyz, device, nmin=2):
             empty_ind = counts >= merge_count
             merged_code[empty_ind[inverse_inds], j:] = -1
 
-        merged_code = torch.unique(merged_code, dim=0)
+        # Merged groups are contiguous rows that became identical, so only consecutive duplicates need to be removed
+        keep_inds = torch.ones(len(merged_code), dtype=torch.bool, device=device)
+        keep_inds[1:] = (merged_code[1:] != merged_code[:-1]).any(dim=1)
 
-        return merged_code
+        return merged_code[keep_inds]
 
 
     def delete_outer_code(code, empty_code):
 
+        code_loc = octree_code2location(code, valid_axis, axis_rank)
+        empty_loc = octree_code2location(empty_code, valid_axis, axis_rank)
+        inner_inds = torch.ones((len(empty_code)), dtype=torch.bool, device=device)
 
-        inner_inds = torch.ones((len(empty_code)), dtype=torch.bool).to(empty_code.device)
-
-        for i in range(len(empty_code)):
-            curr_empty_code = empty_code[i]
-            depth = 0
-            same_par_inds = code[:, depth] == curr_empty_code[depth]
-            same_parent = code.clone()
-
-            if same_par_inds.sum() == 0:
-                inner_inds[i] = False
-
-            while same_par_inds.sum() > 0:
-                depth += 1
-                same_parent = same_parent[same_par_inds]
-                same_par_inds = same_parent[:, depth] == curr_empty_code[depth]
-
-            loc = torch.zeros((len(same_parent), 3)).to(device)
-            empty_loc = torch.zeros((3)).to(device)
-
-            for k in range(depth + 1):
-                valid_axis = k < adaptive_nmax
-                for count, kk in enumerate(torch.nonzero(valid_axis, as_tuple=False).reshape(-1)):
-                    if count == 0:
-                        loc[:, kk] += (2 ** (nmax - k)) * (2 * ((same_parent[:, k] % 4) % 2) - 1)
-                        if curr_empty_code[k] != -1:
-                            empty_loc[kk] += (2 ** (nmax - k)) * (2 * ((curr_empty_code[k] % 4) % 2) - 1)
-                    elif count == 1:
-                        loc[:, kk] += (2 ** (nmax - k)) * (2 * ((same_parent[:, k] % 4) // 2) - 1)
-                        if curr_empty_code[k] != -1:
-                            empty_loc[kk] += (2 ** (nmax - k)) * (2 * ((curr_empty_code[k] % 4) // 2) - 1)
-                    else:
-                        loc[:, kk] += (2 ** (nmax - k)) * (2 * (same_parent[:, k] // 4) - 1)
-                        if curr_empty_code[k] != -1:
-                            empty_loc[kk] += (2 ** (nmax - k)) * (2 * (curr_empty_code[k] // 4) - 1)
-
-            max_loc = loc.max(dim=0)[0]
-            min_loc = loc.min(dim=0)[0]
+        # Empty codes are tested against all populated codes at once, in chunks that bound the pairwise buffers
+        chunk_size = max(1, 2 ** 20 // max(len(code), 1))
 
-            plus_inds = max_loc > 0
-            minus_inds = min_loc < 0
+        for start in range(0, len(empty_code), chunk_size):
+            empty_chunk = empty_code[start: start + chunk_size]
 
-            if (max_loc[plus_inds] < empty_loc[plus_inds]).sum() > 0 or (min_loc[minus_inds] > empty_loc[minus_inds]).sum() > 0:
-                inner_inds[i] = False
+            # The deepest parent shared with the populated codes is given by the longest common prefix,
+            # which ends at the first mismatch since an empty code never equals a populated code
+            shared_depth = (empty_chunk.unsqueeze(1) != code.unsqueeze(0)).byte().argmax(dim=-1)
+            depth = shared_depth.max(dim=1)[0]
+            not_same_parent = (shared_depth != depth.unsqueeze(-1)).unsqueeze(-1)
 
-        return empty_code[inner_inds]
+            loc = code_loc[:, depth].transpose(0, 1)
+            curr_empty_loc = empty_loc[torch.arange(start, start + len(empty_chunk), device=device), depth]
 
+            max_loc = loc.masked_fill(not_same_parent, torch.iinfo(loc.dtype).min).max(dim=1)[0]
+            min_loc = loc.masked_fill(not_same_parent, torch.iinfo(loc.dtype).max).min(dim=1)[0]
 
-    def code2coords(code):
-
-        xyz_coords = torch.zeros((len(code), 3)).to(device)
-        last_merged_ind = (code != -1).sum(dim=1) - 1
-
-        for i in range(nmax - 1, -1, -1):
-            curr_code = code[:, i]
-            empty_ind = (curr_code == -1)
+            plus_inds = max_loc > 0
+            minus_inds = min_loc < 0
 
-            valid_axis = i < adaptive_nmax
+            outer_inds = (plus_inds & (max_loc < curr_empty_loc)).any(-1) | (minus_inds & (min_loc > curr_empty_loc)).any(-1)
+            inner_inds[start: start + chunk_size] = (depth > 0) & ~outer_inds
 
-            loc = torch.zeros((len(curr_code), valid_axis.sum())).to(device)
+        return empty_code[inner_inds]
 
-            for j in range(valid_axis.sum()):
-                if j == 0:
-                    loc[:, j] = (curr_code % 4) % 2
-                elif j == 1:
-                    loc[:, j] = (curr_code % 4) // 2
-                else:
-                    loc[:, j] = curr_code // 4
 
-            loc = loc * 2 - 1
-            loc[empty_ind] = 0
-            xyz_coords[:, valid_axis] += loc * (2 ** (adaptive_nmax[valid_axis] - i - 1)) / scaler[valid_axis]
+    def code2coords(code):
 
-        xyz_coords = torch.unique(xyz_coords, dim=0)
+        xyz_coords = octree_code2coords(code, scaler, valid_axis, axis_rank, bit_depth)
 
         return xyz_coords
 
 
-    code = torch.zeros((len(new_xyz), nmax), dtype=torch.long).to(device)
-
     array_shape = [8] * nmin
     array_shape += [4] * (nmed - nmin)
     array_shape += [2] * (nmax - nmed)
-    empty_inds = torch.ones(array_shape, dtype=torch.bool).to(device)
-
-    plane = torch.zeros((len(new_xyz), 3)).to(device)
+    empty_inds = torch.ones(array_shape, dtype=torch.bool, device=device)
 
-    for depth in range(nmax):
-        code[:, depth] = check_location(new_xyz, depth, plane)
-        plane = update_planes(code, depth, plane)
+    code_key = octree_encode(new_xyz, xyz_length, adaptive_nmax, valid_axis, axis_rank, bit_depth)
 
-    u_code = code.unique(dim=0)
+    u_code = octree_unpack(torch.unique(code_key), nmax)
     empty_inds[tuple(u_code.t())] = False
     empty_code = torch.nonzero(empty_inds, as_tuple=False)
     empty_code = merge_code(empty_code)
@@ -848,10 +791,15 @@ def generate_octree(xyz, device, nmin=2):
 
     empty_coords = code2coords(empty_code)
 
-    return empty_coords + xyz_med
+    return (empty_coords + xyz_med).to(out_device)
 
 
+@torch.no_grad()
 def generate_octree_2d(xyz, height_z, device):
+    # Build on CPU and move the resulting coordinates to device, as in generate_octree
+    out_device = device
+    device = torch.device('cpu')
+    xyz = xyz.to(device)
 
     nmin = 4
 
@@ -874,43 +822,25 @@ def generate_octree_2d(xyz, height_z, device):
 
     nmin = adaptive_nmax.min().item()
     nmax = adaptive_nmax.max().item()
-    
-    def check_location(point, depth, plane):
-        valid_axis = depth < adaptive_nmax
-
-        location = torch.zeros((len(point)), dtype=torch.long).to(device)
-        for count, i in enumerate(torch.nonzero(valid_axis, as_tuple=False).reshape(-1)):
-            location[point[:, i] >= plane[:, i]] += (2 ** count)
-
-        return location
-
-
-    def update_planes(code, depth, plane):
-        res = code[:, depth]
-
-        valid_axis = depth < adaptive_nmax
-        loc = torch.zeros((len(res), valid_axis.sum())).to(device)
-
-        for i in range(valid_axis.sum()):
-            if i == 0:
-                loc[:, i] = (res % 4) % 2
-            elif i == 1:
-                loc[:, i] = (res % 4) // 2
-            else:
-                loc[:, i] = res // 4
-        loc = loc * 2 - 1
-
-        plane[:, valid_axis] += loc * (2 ** (adaptive_nmax[valid_axis] - depth - 1)) / scaler[valid_axis]
-
-        return plane
 
+    # Per-depth tables of the valid axes, the bit of each axis in the code, and the remaining depth of each axis
+    depths = torch.arange(nmax, device=device).unsqueeze(-1)
+    valid_axis = depths < adaptive_nmax
+    axis_rank = (torch.cumsum(valid_axis.long(), dim=-1) - 1).clamp(min=0)
+    bit_depth = adaptive_nmax - depths - 1
 
     def merge_code(code):
 
         merged_code = code.clone()
 
+        # code is sorted and merging only modifies columns from j onwards, so the groups sharing the first j columns
+        # start wherever the first column differing from the previous row is less than j
+        first_diff = torch.zeros(len(code), dtype=torch.long, device=device)
+        first_diff[1:] = (code[1:] != code[:-1]).long().argmax(dim=1)
+
         for i, j in enumerate(range(nmax - 1, 0, -1)):
-            output, inverse_inds, counts = torch.unique_consecutive(merged_code[:, :j], True, True, dim=0)
+            inverse_inds = torch.cumsum(first_diff < j, dim=0) - 1
+            counts = torch.bincount(inverse_inds)
             if j < nmin:
                 merge_count = 2 ** (nmax - nmin) * 4 ** (i + nmin - nmax + 1)
             else:
@@ -919,105 +849,62 @@ def generate_octree_2d(xyz, height_z, device):
             empty_ind = counts >= merge_count
             merged_code[empty_ind[inverse_inds], j:] = -1
 
-        merged_code = torch.unique(merged_code, dim=0)
+        # Merged groups are contiguous rows that became identical, so only consecutive duplicates need to be removed
+        keep_inds = torch.ones(len(merged_code), dtype=torch.bool, device=device)
+        keep_inds[1:] = (merged_code[1:] != merged_code[:-1]).any(dim=1)
 
-        return merged_code
+        return merged_code[keep_inds]
 
 
     def delete_outer_code(code, empty_code):
 
-        inner_inds = torch.ones((len(empty_code)), dtype=torch.bool).to(empty_code.device)
-
-        for i in range(len(empty_code)):
-            curr_empty_code = empty_code[i]
-            depth = 0
-            same_par_inds = code[:, depth] == curr_empty_code[depth]
-            same_parent = code.clone()
-
-            if same_par_inds.sum() == 0:
-                inner_inds[i] = False
-
-            while same_par_inds.sum() > 0:
-                depth += 1
-                same_parent = same_parent[same_par_inds]
-                same_par_inds = same_parent[:, depth] == curr_empty_code[depth]
-
-            loc = torch.zeros((len(same_parent), 2)).to(device)
-            empty_loc = torch.zeros((2)).to(device)
-
-            for k in range(depth + 1):
-                valid_axis = k < adaptive_nmax
-                for count, kk in enumerate(torch.nonzero(valid_axis, as_tuple=False).reshape(-1)):
-                    if count == 0:
-                        loc[:, kk] += (2 ** (nmax - k)) * (2 * ((same_parent[:, k] % 4) % 2) - 1)
-                        if curr_empty_code[k] != -1:
-                            empty_loc[kk] += (2 ** (nmax - k)) * (2 * ((curr_empty_code[k] % 4) % 2) - 1)
-                    elif count == 1:
-                        loc[:, kk] += (2 ** (nmax - k)) * (2 * ((same_parent[:, k] % 4) // 2) - 1)
-                        if curr_empty_code[k] != -1:
-                            empty_loc[kk] += (2 ** (nmax - k)) * (2 * ((curr_empty_code[k] % 4) // 2) - 1)
-                    else:
-                        loc[:, kk] += (2 ** (nmax - k)) * (2 * (same_parent[:, k] // 4) - 1)
-                        if curr_empty_code[k] != -1:
-                            empty_loc[kk] += (2 ** (nmax - k)) * (2 * (curr_empty_code[k] // 4) - 1)
-
-            max_loc = loc.max(dim=0)[0]
-            min_loc = loc.min(dim=0)[0]
+        code_loc = octree_code2location(code, valid_axis, axis_rank)
+        empty_loc = octree_code2location(empty_code, valid_axis, axis_rank)
+        inner_inds = torch.ones((len(empty_code)), dtype=torch.bool, device=device)
 
-            plus_inds = max_loc > 0
-            minus_inds = min_loc < 0
+        # Empty codes are tested against all populated codes at once, in chunks that bound the pairwise buffers
+        chunk_size = max(1, 2 ** 20 // max(len(code), 1))
 
-            if (max_loc[plus_inds] < empty_loc[plus_inds]).sum() > 0 or (min_loc[minus_inds] > empty_loc[minus_inds]).sum() > 0:
-                inner_inds[i] = False
+        for start in range(0, len(empty_code), chunk_size):
+            empty_chunk = empty_code[start: start + chunk_size]
 
-        return empty_code[inner_inds]
+            # The deepest parent shared with the populated codes is given by the longest common prefix,
+            # which ends at the first mismatch since an empty code never equals a populated code
+            shared_depth = (empty_chunk.unsqueeze(1) != code.unsqueeze(0)).byte().argmax(dim=-1)
+            depth = shared_depth.max(dim=1)[0]
+            not_same_parent = (shared_depth != depth.unsqueeze(-1)).unsqueeze(-1)
 
+            loc = code_loc[:, depth].transpose(0, 1)
+            curr_empty_loc = empty_loc[torch.arange(start, start + len(empty_chunk), device=device), depth]
 
-    def code2coords(code):
-
-        xy_coords = torch.zeros((len(code), 2)).to(device)
-        last_merged_ind = (code != -1).sum(dim=1) - 1
+            max_loc = loc.masked_fill(not_same_parent, torch.iinfo(loc.dtype).min).max(dim=1)[0]
+            min_loc = loc.masked_fill(not_same_parent, torch.iinfo(loc.dtype).max).min(dim=1)[0]
 
-        for i in range(nmax - 1, -1, -1):
-            curr_code = code[:, i]
-            empty_ind = (curr_code == -1)
+            plus_inds = max_loc > 0
+            minus_inds = min_loc < 0
 
-            valid_axis = i < adaptive_nmax
+            outer_inds = (plus_inds & (max_loc < curr_empty_loc)).any(-1) | (minus_inds & (min_loc > curr_empty_loc)).any(-1)
+            inner_inds[start: start + chunk_size] = (depth > 0) & ~outer_inds
 
-            loc = torch.zeros((len(curr_code), valid_axis.sum())).to(device)
+        return empty_code[inner_inds]
 
-            for j in range(valid_axis.sum()):
-                if j == 0:
-                    loc[:, j] = (curr_code % 4) % 2
-                elif j == 1:
-                    loc[:, j] = (curr_code % 4) // 2
-                else:
-                    loc[:, j] = curr_code // 4
 
-            loc = loc * 2 - 1
-            loc[empty_ind] = 0
-            xy_coords[:, valid_axis] += loc * (2 ** (adaptive_nmax[valid_axis] - i - 1)) / scaler[valid_axis]
+    def code2coords(code):
 
-        xy_coords = torch.unique(xy_coords, dim=0)
+        xy_coords = octree_code2coords(code, scaler, valid_axis, axis_rank, bit_depth)
         xyz_coords = torch.cat([xy_coords, torch.ones_like(xy_coords[:, 0:1]) * height_z], dim=-1)
 
         return xyz_coords
 
 
-    code = torch.zeros((len(new_xy), nmax), dtype=torch.long).to(device)
-
     array_shape = [4] * nmin
     array_shape += [2] * (nmax - nmin)
 
-    empty_inds = torch.ones(array_shape, dtype=torch.bool).to(device)
-
-    plane = torch.zeros((len(new_xy), 2)).to(device)
+    empty_inds = torch.ones(array_shape, dtype=torch.bool, device=device)
 
-    for depth in range(nmax):
-        code[:, depth] = check_location(new_xy, depth, plane)
-        plane = update_planes(code, depth, plane)
+    code_key = octree_encode(new_xy, xy_length, adaptive_nmax, valid_axis, axis_rank, bit_depth)
 
-    u_code = code.unique(dim=0)
+    u_code = octree_unpack(torch.unique(code_key), nmax)
     empty_inds[tuple(u_code.t())] = False
     empty_code = torch.nonzero(empty_inds, as_tuple=False)
     empty_code = merge_code(empty_code)
@@ -1026,7 +913,7 @@ def generate_octree_2d(xyz, height_z, device):
     empty_coords = code2coords(empty_code)
     empty_coords = empty_coords + torch.cat([xy_med, torch.zeros_like(xy_med[0:1])], dim=0)
 
-    return empty_coords
+    return empty_coords.to(out_device)
 
 
 # Code excerpted from https://github.com/haruishi43/equilib
@@ -1056,6 +943,32 @@ def create_area_mask(h_out: int, w_out: int, device=torch.device('cpu')) -> np.n
     return torch.stack([phi] * w_out, dim=1)  # h_out * w_out
 
 
+@lru_cache(maxsize=8)
+def compute_sphere_grid(num_split_h: int, num_split_w: int, device: torch.device) -> torch.Tensor:
+    """
+    Unit sphere points at the pixel centers of a (num_split_h, num_split_w) equirectangular grid
+    The result is cached and shared across calls, so it should not be modified in-place
+
+    Args:
+        num_split_h: Number of horizontal splits
+        num_split_w: Number of vertical splits
+        device: Device to place the grid on
+
+    Returns:
+        A: (num_split_h, num_split_w, 3) torch tensor containing xyz coordinates of the grid
+    """
+    a = create_coordinate(num_split_h, num_split_w, device)
+    a[..., 0] -= np.pi / (num_split_w)  # Add offset to align sampling grid to each pixel center
+    a[..., 1] += np.pi / (num_split_h * 2)  # Add offset to align sampling grid to each pixel center
+    norm_A = 1
+    x = norm_A * torch.sin(a[:, :, 1]) * torch.cos(a[:, :, 0])
+    y = norm_A * torch.sin(a[:, :, 1]) * torch.sin(a[:, :, 0])
+    z = norm_A * torch.cos(a[:, :, 1])
+    A = torch.stack((x, y, z), dim=-1)  # (H, W, 3)
+
+    return A
+
+
 def compute_sampling_grid(ypr, num_split_h, num_split_w, inverse=False):
     """
     Utility function for computing sampling grid using yaw, pitch, roll
@@ -1071,33 +984,48 @@ def compute_sampling_grid(ypr, num_split_h, num_split_w, inverse=False):
 
     Indices are assumed to be ordered in compliance to the above convention.
     Args:
-        ypr: torch.tensor of shape (3, ) containing yaw, pitch, roll
+        ypr: torch.tensor of shape (3, ) or (B, 3) containing yaw, pitch, roll
         num_split_h: Number of horizontal splits
         num_split_w: Number of vertical splits
         inverse: If True, calculates sampling grid with inverted rotation provided from ypr
 
     Returns:
-        grid: Sampling grid for generating rotated images according to yaw, pitch, roll
+        grid: (H, W, 2) or (B, H, W, 2) sampling grid for generating rotated images according to yaw, pitch, roll
     """
     if inverse:
         R = rot_from_ypr(ypr)
     else:
-        R = rot_from_ypr(ypr).T
+        R = rot_from_ypr(ypr).transpose(-2, -1)
 
     H, W = num_split_h, num_split_w
-    a = create_coordinate(H, W, ypr.device)
-    a[..., 0] -= np.pi / (num_split_w)  # Add offset to align sampling grid to each pixel center
-    a[..., 1] += np.pi / (num_split_h * 2)  # Add offset to align sampling grid to each pixel center
-    norm_A = 1
-    x = norm_A * torch.sin(a[:, :, 1]) * torch.cos(a[:, :, 0])
-    y = norm_A * torch.sin(a[:, :, 1]) * torch.sin(a[:, :, 0])
-    z = norm_A * torch.cos(a[:, :, 1])
-    A = torch.stack((x, y, z), dim=-1)  # (H, W, 3)
-    _B = R @ A.unsqueeze(3)
-    _B = _B.squeeze(3)
-    grid = cloud2idx(_B.reshape(-1, 3)).reshape(H, W, 2)
+    A = compute_sphere_grid(H, W, ypr.device)  # (H, W, 3)
+    _B = A.reshape(-1, 3) @ R.transpose(-2, -1)  # (H * W, 3) or (B, H * W, 3)
+    grid = cloud2idx(_B, batched=len(ypr.shape) == 2).reshape(*ypr.shape[:-1], H, W, 2)
     return grid
 
+
+def compute_sampling_index(grid: torch.Tensor, resolution: Tuple[int, int]) -> torch.Tensor:
+    """
+    Convert a sampling grid to flat pixel indices, so that nearest neighbor warping becomes a single gather
+    Indexing the flattened image with the indices is equivalent to warp_from_img with mode='nearest'
+
+    Args:
+        grid: (..., H, W, 2) sampling grid ranged in [-1, 1], as returned from compute_sampling_grid
+        resolution: Tuple containing the height and width of the image to sample from
+
+    Returns:
+        sample_idx: (..., H * W) torch tensor containing indices to the flattened (H_in * W_in) image
+    """
+    H_in, W_in = resolution
+    sample_arr = torch.clip(grid, min=-0.99, max=0.99)
+
+    # Unnormalize following grid_sample with align_corners=False, and round to nearest as in mode='nearest'
+    x_idx = torch.round(((sample_arr[..., 0] + 1) * W_in - 1) / 2).long().clamp(0, W_in - 1)
+    y_idx = torch.round(((sample_arr[..., 1] + 1) * H_in - 1) / 2).long().clamp(0, H_in - 1)
+    sample_idx = (y_idx * W_in + x_idx).flatten(-2)
+
+    return sample_idx
+
 # Color conversion code excepted from Kornia: https://github.com/kornia/kornia
 
 def rgb_to_grayscale(
@@ -1149,8 +1077,28 @@ def rgb_to_grayscale(
     return w_r * r + w_g * g + w_b * b
 
 
+def split_img(img: torch.Tensor, num_split_h: int, num_split_w: int) -> torch.Tensor:
+    """
+    Split image into a grid of patches with a single reshape
+
+    Args:
+        img: (..., H, W, C) torch tensor, where H and W are divisible by num_split_h and num_split_w respectively
+        num_split_h: Number of split along horizontal direction
+        num_split_w: Number of split along vertical direction
+
+    Returns:
+        img_chunk: (..., num_split_h * num_split_w, H // num_split_h, W // num_split_w, C) torch tensor of patches in row-major order
+    """
+    H, W, C = img.shape[-3:]
+    batch_shape = img.shape[:-3]
+    img_chunk = img.reshape(*batch_shape, num_split_h, H // num_split_h, num_split_w, W // num_split_w, C).transpose(-4, -3)
+
+    return img_chunk.reshape(*batch_shape, num_split_h * num_split_w, H // num_split_h, W // num_split_w, C)
+
+
 def make_score_map_2d(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tensor, trans: torch.Tensor, rot: torch.Tensor,
-        num_split_h: int, num_split_w: int, margin: Union[int, tuple]) -> Tuple[torch.Tensor, torch.Tensor]:
+        num_split_h: int, num_split_w: int, margin: Union[int, tuple], hist_dtype: Optional[torch.dtype] = None,
+        rot_batch_size: int = 64) -> Tuple[torch.Tensor, torch.Tensor]:
     """
     Generate map displaying inliers, outliers in query image
 
@@ -1163,6 +1111,8 @@ def make_score_map_2d(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tensor, t
         num_split_h: Number of split along horizontal direction
         num_split_w: Number of split along vertical direction
         margin: Vertical margin for ignoring zero values
+        hist_dtype: If provided, histograms are warped and intersected in hist_dtype (e.g. torch.bfloat16 on CUDA), while intersections are summed in float
+        rot_batch_size: Number of rotations warped at once, bounding the memory of the warped histograms
 
     Returns:
         max_intersect: (num_split_h, num_split_w) tensor containing the amount each patch is considered an inlier
@@ -1170,24 +1120,18 @@ def make_score_map_2d(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tensor, t
     num_bins = [8, 8, 8]
 
     img = img.clone().detach() * 255
-    # masking coordinates to remove pixels whose RGB value is [0, 0, 0]
-    img_mask = torch.zeros([img.shape[0], img.shape[1]], dtype=torch.bool, device=img.device)
-    img_mask[torch.sum(img == 0, dim=2) != 3] = True
-
     # histograms are made from split images, then split histogram intersection is summed
     tot_intersect = torch.zeros((len(trans), len(rot), num_split_h * num_split_w), device=img.device)
 
-    img_chunk = []
-    for img_hor_chunk in torch.chunk(img, num_split_h, dim=0):
-        img_chunk += [*torch.chunk(img_hor_chunk, num_split_w, dim=1)]
-
-    img_chunk = torch.stack(img_chunk, dim=0)  # (B, H, W, C)
-    img_mask_chunk = torch.zeros(img_chunk.shape[0], img_chunk.shape[1], img_chunk.shape[2], dtype=torch.bool, device=xyz.device)
-    img_mask_chunk[torch.sum(img_chunk == 0, dim=-1) != 3] = True
+    img_chunk = split_img(img, num_split_h, num_split_w)  # (B, H, W, C)
+    # masking coordinates to remove pixels whose RGB value is [0, 0, 0]
+    img_mask_chunk = (img_chunk != 0).any(dim=-1)
     img_hist = histogram(img_chunk, img_mask_chunk, num_bins)
+    if hist_dtype is not None:
+        img_hist = img_hist.to(hist_dtype)
 
-    # Initialize grid sample locations
-    grid_list = [compute_sampling_grid(ypr, num_split_h, num_split_w) for ypr in rot]
+    # Initialize grid sample locations for all rotations at once
+    grid_arr = compute_sampling_grid(rot, num_split_h, num_split_w)  # (K, num_split_h, num_split_w, 2)
 
     with tqdm(desc="Inlier Detection (2D)", total=len(trans) * len(rot)) as pbar:
         for i in range(len(trans)):
@@ -1196,26 +1140,25 @@ def make_score_map_2d(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tensor, t
             proj_img = make_pano(torch.transpose(torch.matmul(R, torch.transpose(xyz - trans[i], 0, 1)), 0, 1), rgb, resolution=(img.shape[0], img.shape[1]), return_torch=True)
 
             # Make chunks which are splits of the original panorama
-            proj_chunk = []
-            for proj_hor_chunk in torch.chunk(proj_img, num_split_h, dim=0):
-                proj_chunk += [*torch.chunk(proj_hor_chunk, num_split_w, dim=1)]
-
-            proj_chunk = torch.stack(proj_chunk, dim=0)  # (B, H, W, C)
+            proj_chunk = split_img(proj_img, num_split_h, num_split_w)  # (B, H, W, C)
 
             # Mask chunks
-            proj_mask_chunk = torch.zeros(proj_chunk.shape[0], proj_chunk.shape[1], proj_chunk.shape[2], dtype=torch.bool, device=xyz.device)
-            proj_mask_chunk[torch.sum(proj_chunk == 0, dim=-1) != 3] = True
+            proj_mask_chunk = (proj_chunk != 0).any(dim=-1)
             proj_mask_chunk = torch.logical_and(proj_mask_chunk, img_mask_chunk)
 
             # Compute histogram
             orig_proj_hist = histogram(proj_chunk, proj_mask_chunk, num_bins)  # (num_split_h * num_split_w, num_bins[0], ...)
             orig_proj_hist = orig_proj_hist.reshape(num_split_h, num_split_w, -1)
+            if hist_dtype is not None:
+                orig_proj_hist = orig_proj_hist.to(hist_dtype)
 
-            for j in range(len(rot)):
-                proj_hist = warp_from_img(orig_proj_hist, grid_list[j], padding='reflection', mode='nearest').reshape(-1, *num_bins)
-                cand_intersect = histogram_intersection(img_hist, proj_hist)
-                tot_intersect[i, j] = cand_intersect
-                pbar.update(1)
+            # Warp histograms for a batch of rotations in a single grid_sample and intersect them in one batch
+            for j in range(0, len(rot), rot_batch_size):
+                batch_grid = grid_arr[j: j + rot_batch_size]
+                proj_hist = warp_from_img(orig_proj_hist, batch_grid, padding='reflection', mode='nearest')
+                proj_hist = proj_hist.reshape(len(batch_grid), num_split_h * num_split_w, -1)
+                tot_intersect[i, j: j + rot_batch_size] = torch.min(img_hist.reshape(1, num_split_h * num_split_w, -1), proj_hist).sum(-1, dtype=torch.float)
+                pbar.update(len(batch_grid))
 
         # Outlier rejection
         max_intersect = tot_intersect.reshape(-1, num_split_h * num_split_w).max(0).values
@@ -1236,14 +1179,11 @@ def make_score_map_2d(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tensor, t
 
 
 def process_score_map_2d(img, inlier_map, method, inlier_thres):
-    new_inlier_map = inlier_map.clone().detach()
+    new_inlier_map = inlier_map.detach()
     if method == 'absolute_thres':
-        # Make boolean map for hard thresholding
+        # Make boolean map for hard thresholding, where interpolation is nearest so the map stays binary
         H, W = new_inlier_map.shape
-        new_inlier_map = new_inlier_map.flatten()
-        new_inlier_map[new_inlier_map >= inlier_thres] = 1.0
-        new_inlier_map[new_inlier_map < inlier_thres] = 0.0
-        new_inlier_map = new_inlier_map.reshape(H, W)
+        new_inlier_map = (new_inlier_map >= inlier_thres).float()
         new_inlier_map = torch.nn.functional.interpolate(new_inlier_map.reshape(1, 1, H, W), size=[img.shape[0], img.shape[1]]).squeeze()
 
         if isinstance(img, np.ndarray):
@@ -1266,7 +1206,8 @@ def process_score_map_2d(img, inlier_map, method, inlier_thres):
 
 
 def make_score_map_3d(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tensor, trans: torch.Tensor, rot: torch.Tensor,
-        num_split_h: int, num_split_w: int, margin: Union[int, tuple], filename: str = None, num_query: int = 1, match_rgb: bool = True) -> Tuple[torch.Tensor, torch.Tensor]:
+        num_split_h: int, num_split_w: int, margin: Union[int, tuple], filename: str = None, num_query: int = 1, match_rgb: bool = True,
+        hist_dtype: Optional[torch.dtype] = None, rot_batch_size: int = 64) -> Tuple[torch.Tensor, torch.Tensor]:
     """
     Generate map displaying inliers, outliers in point cloud
 
@@ -1282,6 +1223,8 @@ def make_score_map_3d(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tensor, t
         filename: If provided, specifies the directory where query images are saved
         num_query: Number of query images to generate score pcd. If not specified, defaults to 1
         match_rgb: If True, matches query images with point cloud's distribution
+        hist_dtype: If provided, histograms are warped and intersected in hist_dtype (e.g. torch.bfloat16 on CUDA), while scores are kept in float
+        rot_batch_size: Number of rotations warped at once, bounding the memory of the warped histograms and intersections
 
     Returns:
         score_cloud: (N, 1) tensor containing the amount each point is considered an inlier
@@ -1309,31 +1252,21 @@ def make_score_map_3d(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tensor, t
     with tqdm(desc="Inlier Detection (3D)", total=len(trans) * len(rot)) as pbar:
         # Point cloud where scores will be saved
         score_cloud = torch.zeros([xyz.shape[0], 1], device=xyz.device)
-        # Initialize grid sample locations
-        grid_list = [compute_sampling_grid(ypr, num_split_h, num_split_w) for ypr in rot]
+        # Initialize grid sample locations for all rotations at once
+        grid_arr = compute_sampling_grid(rot, num_split_h, num_split_w)  # (K, num_split_h, num_split_w, 2)
 
         # Obtain inverse grid sample locations
-        inv_grid_list = [compute_sampling_grid(ypr, num_split_h, num_split_w, inverse=True) for ypr in rot]
+        inv_grid_arr = compute_sampling_grid(rot, num_split_h, num_split_w, inverse=True)  # (K, num_split_h, num_split_w, 2)
 
         total_count = 0  # Used for running average tracking
 
-        img_hist_list = []
-
-        # Cache all histograms from selected query images
-        for img in img_list:
-            # masking coordinates to remove pixels whose RGB value is [0, 0, 0]
-            img_mask = torch.zeros([img.shape[0], img.shape[1]], dtype=torch.bool, device=img.device)
-            img_mask[torch.sum(img == 0, dim=2) != 3] = True
-
-            img_chunk = []
-            for img_hor_chunk in torch.chunk(img, num_split_h, dim=0):
-                img_chunk += [*torch.chunk(img_hor_chunk, num_split_w, dim=1)]
-
-            img_chunk = torch.stack(img_chunk, dim=0)  # (B, H, W, C)
-            img_mask_chunk = torch.zeros(img_chunk.shape[0], img_chunk.shape[1], img_chunk.shape[2], dtype=torch.bool, device=xyz.device)
-            img_mask_chunk[torch.sum(img_chunk == 0, dim=-1) != 3] = True
-            img_hist = histogram(img_chunk, img_mask_chunk, num_bins)
-            img_hist_list.append(img_hist)
+        # Cache chunks, masks, and histograms from all selected query images at once
+        num_img = len(img_list)
+        img_chunk = torch.stack([split_img(query_img, num_split_h, num_split_w) for query_img in img_list], dim=0)  # (Q, B, H, W, C)
+        img_mask_chunk = (img_chunk != 0).any(dim=-1)  # Remove pixels whose RGB value is [0, 0, 0]
+        img_hist_list = histogram(img_chunk.flatten(0, 1), img_mask_chunk.flatten(0, 1), num_bins).reshape(num_img, -1, *num_bins)
+        if hist_dtype is not None:
+            img_hist_list = img_hist_list.to(hist_dtype)
 
         # Generate intersections with synthetic views
         for i in range(len(trans)):
@@ -1349,35 +1282,42 @@ def make_score_map_3d(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tensor, t
             quant_proj_coords = quant_proj_coords.long()
 
             # Make chunks which are splits of the original panorama
-            proj_chunk = []
-            for proj_hor_chunk in torch.chunk(proj_img, num_split_h, dim=0):
-                proj_chunk += [*torch.chunk(proj_hor_chunk, num_split_w, dim=1)]
-
-            proj_chunk = torch.stack(proj_chunk, dim=0)  # (B, H, W, C)
+            proj_chunk = split_img(proj_img, num_split_h, num_split_w)  # (B, H, W, C)
 
             # Mask chunks
-            proj_mask_chunk = torch.zeros(proj_chunk.shape[0], proj_chunk.shape[1], proj_chunk.shape[2], dtype=torch.bool, device=xyz.device)
-            proj_mask_chunk[torch.sum(proj_chunk == 0, dim=-1) != 3] = True
-            proj_mask_chunk = torch.logical_and(proj_mask_chunk, img_mask_chunk)
-
-            # Compute histogram
-            orig_proj_hist = histogram(proj_chunk, proj_mask_chunk, num_bins)  # (num_split_h * num_split_w, num_bins[0], ...)
-            orig_proj_hist = orig_proj_hist.reshape(num_split_h, num_split_w, -1)
-
-            for j in range(len(rot)):
-                proj_hist = warp_from_img(orig_proj_hist, grid_list[j], padding='reflection', mode='nearest').reshape(-1, *num_bins)
-
-                # Iterate over each image
-                for img_hist in img_hist_list:
-                    cand_intersect = histogram_intersection(img_hist, proj_hist)
-                    total_count += 1
-
-                    # Assign scores to score_cloud, note that warped histograms are inverted to original identity rotation to match with quant_proj_coords
-                    inv_hist = warp_from_img(cand_intersect.reshape(num_split_h, num_split_w, 1), inv_grid_list[j], padding='reflection', mode='nearest')
-                    update = inv_hist[(quant_proj_coords[:, 0], quant_proj_coords[:, 1])]
-                    update[update == 0.] = score_cloud[update == 0.]
-                    score_cloud = score_cloud * (total_count - 1) / total_count + update * 1 / total_count
-                pbar.update(1)
+            proj_mask_chunk = (proj_chunk != 0).any(dim=-1)
+            proj_mask_chunk = torch.logical_and(proj_mask_chunk.unsqueeze(0), img_mask_chunk)  # Separate masks for each query image
+
+            # Compute histogram, where histograms of each query image are stacked along channels to be warped together
+            orig_proj_hist = histogram(proj_chunk.expand_as(img_chunk).flatten(0, 1), proj_mask_chunk.flatten(0, 1), num_bins)  # (Q * B, num_bins[0], ...)
+            orig_proj_hist = orig_proj_hist.reshape(num_img, num_split_h, num_split_w, -1).permute(1, 2, 0, 3).reshape(num_split_h, num_split_w, -1)
+            if hist_dtype is not None:
+                orig_proj_hist = orig_proj_hist.to(hist_dtype)
+
+            for j in range(0, len(rot), rot_batch_size):
+                batch_grid = grid_arr[j: j + rot_batch_size]
+                batch_inv_grid = inv_grid_arr[j: j + rot_batch_size]
+
+                # Warp histograms for a batch of rotations at once and intersect them with every query image in one batch
+                proj_hist = warp_from_img(orig_proj_hist, batch_grid, padding='reflection', mode='nearest')
+                proj_hist = proj_hist.reshape(len(batch_grid), num_split_h * num_split_w, num_img, -1)
+                cand_intersect = torch.min(img_hist_list.reshape(num_img, num_split_h * num_split_w, -1).transpose(0, 1), proj_hist).sum(-1, dtype=torch.float)
+
+                # Warped intersections are inverted to original identity rotation to match with quant_proj_coords
+                inv_hist = warp_from_img(cand_intersect.reshape(len(batch_grid), num_split_h, num_split_w, num_img), batch_inv_grid, padding='reflection', mode='nearest')
+
+                for batch_idx in range(len(batch_grid)):
+                    point_hist = inv_hist[batch_idx][(quant_proj_coords[:, 0], quant_proj_coords[:, 1])]  # (N, Q)
+
+                    # Iterate over each image
+                    for img_idx in range(num_img):
+                        total_count += 1
+
+                        # Assign scores to score_cloud as a running average, where points without scores keep their values
+                        update = point_hist[:, img_idx: img_idx + 1]
+                        update = torch.where(update == 0., score_cloud, update)
+                        score_cloud = score_cloud * (total_count - 1) / total_count + update * 1 / total_count
+                    pbar.update(1)
         
         # Normalize score_cloud to range in [0, 1]
         score_cloud = (score_cloud - score_cloud.min()) / (score_cloud.max() - score_cloud.min())
@@ -1385,28 +1325,35 @@ def make_score_map_3d(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tensor, t
 
 
 def process_split_intersection(cand_intersect: torch.tensor, stat: str = 'mean', low_cutoff=0.25, high_cutoff=0.75):
-    # Process intersection values of shape (B, ) with a designated statistic
+    # Process intersection values of shape (B, ) or (..., B) with a designated statistic over the nonzero values of the last dimension
+    # Results are kept as tensors of shape (..., ) to avoid synchronizing with the device
+    num_valid = (cand_intersect != 0.0).sum(-1)  # (..., )
+
     if stat == 'mean':
-        if cand_intersect.nonzero(as_tuple=False).shape[0] != 0:
-            hist_intersect = cand_intersect.sum().item() / cand_intersect.nonzero(as_tuple=False).shape[0]
-        else:
-            hist_intersect = 0.0
-    elif stat == 'midhinge':
-        cand_intersect = cand_intersect[cand_intersect != 0.0].sort()[0]
-        hist_intersect = ((cand_intersect[int(cand_intersect.shape[0] * low_cutoff)]
-            + cand_intersect[int(cand_intersect.shape[0] * high_cutoff)]) / 2.).item()
-    elif stat == 'median':
-        hist_intersect = cand_intersect[cand_intersect != 0.0].median().item()
-    elif stat == 'interquartile':
-        cand_intersect = cand_intersect[cand_intersect != 0.0].sort()[0]
-        hist_intersect = cand_intersect[int(cand_intersect.shape[0] * low_cutoff): int(cand_intersect.shape[0] * high_cutoff)].mean().item()
-    elif stat == 'winsorized':
-        cand_intersect = cand_intersect[cand_intersect != 0.0].sort()[0]
-        q1_idx = int(cand_intersect.shape[0] * low_cutoff)
-        q3_idx = int(cand_intersect.shape[0] * high_cutoff)
-        cand_intersect[:q1_idx] = cand_intersect[q1_idx]
-        cand_intersect[q3_idx:] = cand_intersect[q3_idx]
-        hist_intersect = cand_intersect.mean().item()
+        hist_intersect = torch.where(num_valid != 0, cand_intersect.sum(-1) / num_valid.clamp(min=1), torch.zeros_like(cand_intersect[..., 0]))
+    else:
+        # Sort nonzero values to the front of each row in ascending order
+        sort_intersect = cand_intersect.masked_fill(cand_intersect == 0.0, float('inf')).sort(dim=-1)[0]
+        q1_idx = (num_valid.double() * low_cutoff).long().unsqueeze(-1)
+        q3_idx = (num_valid.double() * high_cutoff).long().unsqueeze(-1)
+        max_idx = cand_intersect.shape[-1] - 1
+
+        if stat == 'midhinge':
+            hist_intersect = (sort_intersect.gather(-1, q1_idx.clamp(max=max_idx)) + sort_intersect.gather(-1, q3_idx.clamp(max=max_idx))) / 2.
+            hist_intersect = hist_intersect.squeeze(-1)
+        elif stat == 'median':
+            median_idx = ((num_valid - 1).clamp(min=0) // 2).unsqueeze(-1)
+            hist_intersect = sort_intersect.gather(-1, median_idx).squeeze(-1)
+        elif stat == 'interquartile':
+            pos = torch.arange(cand_intersect.shape[-1], device=cand_intersect.device)
+            in_range = (pos >= q1_idx) & (pos < q3_idx)
+            hist_intersect = sort_intersect.masked_fill(~in_range, 0.).sum(-1) / in_range.sum(-1)
+        elif stat == 'winsorized':
+            pos = torch.arange(cand_intersect.shape[-1], device=cand_intersect.device)
+            low = sort_intersect.gather(-1, q1_idx.clamp(max=max_idx))
+            high = sort_intersect.gather(-1, q3_idx.clamp(max=max_idx))
+            clamp_intersect = torch.max(torch.min(sort_intersect, high), low)
+            hist_intersect = clamp_intersect.masked_fill(pos >= num_valid.unsqueeze(-1), 0.).sum(-1) / num_valid
 
     return hist_intersect
 
@@ -1419,8 +1366,39 @@ def compute_sin_grid(num_split_h, num_split_w, device):
     return sin_grid
 
 
+@torch.jit.script
+def batch_hist_intersection(hist_1: torch.Tensor, hist_2: torch.Tensor) -> torch.Tensor:
+    # Intersection of (..., C_0, C_1, C_2) color histograms, where inputs are broadcast against each other
+    # and intersections of shape (..., ) are returned
+    num_bins = hist_1.shape[-3] * hist_1.shape[-2] * hist_1.shape[-1]
+    return torch.min(hist_1.reshape(hist_1.shape[:-3] + [num_bins]), hist_2.reshape(hist_2.shape[:-3] + [num_bins])).sum(-1)
+
+
+@torch.jit.script
+def score_split_hist(orig_proj_hist: torch.Tensor, sample_idx: torch.Tensor, img_hist: torch.Tensor,
+        split_weight: Optional[torch.Tensor]) -> torch.Tensor:
+    """
+    Rotate split histograms of projected panoramas and intersect them with the image split histograms
+
+    Args:
+        orig_proj_hist: (B_trans, B, num_bins[0], ...) torch tensor containing split histograms of projected panoramas
+        sample_idx: (K_rot, B) torch tensor containing split indices for each rotation, from compute_sampling_index
+        img_hist: (B, num_bins[0], ...) torch tensor containing split histograms of the image
+        split_weight: (B, ) torch tensor containing weights for each split, or None
+
+    Returns:
+        cand_intersect: (B_trans, K_rot, B) torch tensor containing split intersections of each translation and rotation
+    """
+    proj_hist_arr = orig_proj_hist[:, sample_idx]  # (B_trans, K_rot, B, num_bins[0], ...)
+    cand_intersect = batch_hist_intersection(img_hist, proj_hist_arr)  # (B_trans, K_rot, B)
+    if split_weight is not None:
+        cand_intersect = cand_intersect * split_weight
+    return cand_intersect
+
+
 def histogram_pose_search(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tensor, trans: torch.Tensor, rot: torch.Tensor,
-        num_input: int, num_split_h: int, num_split_w: int, img_weight: torch.tensor, use_sin_weight: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+        num_input: int, num_split_h: int, num_split_w: int, img_weight: torch.tensor, use_sin_weight: bool = False,
+        trans_batch_size: int = 1, rot_batch_size: int = 64) -> Tuple[torch.Tensor, torch.Tensor]:
     """
     Trim translation starting point & rotation by comparing color histrogram in a highly accelerated fashion with cached rotation.
 
@@ -1435,6 +1413,8 @@ def histogram_pose_search(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tenso
         num_split_w: Number of split along vertical direction
         img_weight: Weight mask applied to image
         use_sin_weight: If True, uses sin weight for histogram intersection
+        trans_batch_size: Number of translations whose panoramas are projected at once, trading memory for speed
+        rot_batch_size: Number of rotations whose split histograms are gathered and intersected at once, bounding their memory
 
     Returns:
         trimmed_trans: (num_input, 3) torch tensor containing trimmed translation starting point
@@ -1444,60 +1424,50 @@ def histogram_pose_search(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tenso
 
     img = img.clone().detach() * 255
     # masking coordinates to remove pixels whose RGB value is [0, 0, 0]
-    img_mask = torch.zeros([img.shape[0], img.shape[1]], dtype=torch.bool, device=img.device)
-    img_mask[torch.sum(img == 0, dim=2) != 3] = True
+    img_mask = (img != 0).any(-1)
 
     # histograms are made from split images, then split histogram intersection is summed
     hist_intersect = torch.zeros((len(trans), len(rot)), device=img.device)
+    img_hist = split_histogram(img, img_mask, num_split_h, num_split_w, num_bins, unit_range=False)  # (B, num_bins[0], ...)
 
-    img_chunk = []
-    for img_hor_chunk in torch.chunk(img, num_split_h, dim=0):
-        img_chunk += [*torch.chunk(img_hor_chunk, num_split_w, dim=1)]
-
-    img_chunk = torch.stack(img_chunk, dim=0)  # (B, H, W, C)
-    img_mask_chunk = torch.zeros(img_chunk.shape[0], img_chunk.shape[1], img_chunk.shape[2], dtype=torch.bool, device=xyz.device)
-    img_mask_chunk[torch.sum(img_chunk == 0, dim=-1) != 3] = True
-    img_hist = histogram(img_chunk, img_mask_chunk, num_bins)
-
-    # Initialize grid sample locations
-    grid_list = [compute_sampling_grid(ypr, num_split_h, num_split_w) for ypr in rot]
+    # Initialize grid sample locations for all rotations at once, where nearest neighbor warping is done as a gather
+    grid_arr = compute_sampling_grid(rot, num_split_h, num_split_w)  # (K_rot, num_split_h, num_split_w, 2)
+    sample_idx = compute_sampling_index(grid_arr, (num_split_h, num_split_w))  # (K_rot, B)
     sin_weight = compute_sin_grid(num_split_h, num_split_w, xyz.device)
 
+    # Weights applied to split intersections, shared across all candidates
+    if use_sin_weight and img_weight is None:
+        split_weight = sin_weight.flatten()
+    elif use_sin_weight and img_weight is not None:
+        split_weight = sin_weight.flatten() * 0.5 + img_weight.flatten() * 0.5
+    elif not use_sin_weight and img_weight is not None:
+        split_weight = img_weight.flatten()
+    else:
+        split_weight = None
+
     with tqdm(desc="Hist Initialization", total=len(trans) * len(rot)) as pbar:
-        for i in range(len(trans)):
-            R = torch.eye(3, device=xyz.device)
-            # make panorama from xyz, rgb
-            proj_img = make_pano(torch.transpose(torch.matmul(R, torch.transpose(xyz - trans[i], 0, 1)), 0, 1), rgb, resolution=(img.shape[0], img.shape[1]), return_torch=True)
+        for i in range(0, len(trans), trans_batch_size):
+            batch_trans = trans[i: i + trans_batch_size]
 
-            # Make chunks which are splits of the original panorama
-            proj_chunk = []
-            for proj_hor_chunk in torch.chunk(proj_img, num_split_h, dim=0):
-                proj_chunk += [*torch.chunk(proj_hor_chunk, num_split_w, dim=1)]
+            # make panoramas from xyz, rgb for a batch of translations
+            proj_img = make_pano(xyz.unsqueeze(0) - batch_trans.unsqueeze(1), rgb, resolution=(img.shape[0], img.shape[1]), return_torch=True)
 
-            proj_chunk = torch.stack(proj_chunk, dim=0)  # (B, H, W, C)
+            # Mask panoramas
+            proj_mask = torch.logical_and((proj_img != 0).any(-1), img_mask)
 
-            # Mask chunks
-            proj_mask_chunk = torch.zeros(proj_chunk.shape[0], proj_chunk.shape[1], proj_chunk.shape[2], dtype=torch.bool, device=xyz.device)
-            proj_mask_chunk[torch.sum(proj_chunk == 0, dim=-1) != 3] = True
-            proj_mask_chunk = torch.logical_and(proj_mask_chunk, img_mask_chunk)
+            # Compute histogram of splits, which are rotated and intersected for a batch of rotations at once
+            # make_pano returns colors in [0, 255], so the range is given to avoid synchronizing with the device
+            orig_proj_hist = split_histogram(proj_img, proj_mask, num_split_h, num_split_w, num_bins, unit_range=False)  # (B_trans, B, num_bins[0], ...)
 
-            # Compute histogram
-            orig_proj_hist = histogram(proj_chunk, proj_mask_chunk, num_bins)  # (num_split_h * num_split_w, num_bins[0], ...)
-            orig_proj_hist = orig_proj_hist.reshape(num_split_h, num_split_w, -1)
+            for j in range(0, len(rot), rot_batch_size):
+                batch_sample_idx = sample_idx[j: j + rot_batch_size]
+                cand_intersect = score_split_hist(orig_proj_hist, batch_sample_idx, img_hist, split_weight)  # (B_trans, B_rot, B)
 
-            for j in range(len(rot)):
-                proj_hist = warp_from_img(orig_proj_hist, grid_list[j], padding='reflection', mode='nearest').reshape(-1, *num_bins)
-                cand_intersect = histogram_intersection(img_hist, proj_hist)
-                if use_sin_weight and img_weight is None:
-                    cand_intersect *= sin_weight.flatten()
-                elif use_sin_weight and img_weight is not None:
-                    cand_intersect *= (sin_weight.flatten() * 0.5 + img_weight.flatten() * 0.5)
-                elif not use_sin_weight and img_weight is not None:
-                    cand_intersect *= img_weight.flatten()
-                hist_intersect[i, j] = process_split_intersection(cand_intersect)
-                pbar.update(1)
+                hist_intersect[i: i + len(batch_trans), j: j + rot_batch_size] = process_split_intersection(cand_intersect)
+                pbar.update(len(batch_trans) * len(batch_sample_idx))
 
-        min_inds = hist_intersect.flatten().argsort()[-num_input:]
+        # Top candidates in ascending order of intersection, as with argsort()[-num_input:]
+        min_inds = hist_intersect.flatten().topk(min(num_input, hist_intersect.numel()))[1].flip(0)
 
         trimmed_trans = trans[min_inds // len(rot)]
         trimmed_rot = rot[min_inds % len(rot)]
@@ -1505,6 +1475,32 @@ def histogram_pose_search(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tenso
         return trimmed_trans, trimmed_rot
 
 
+def scatter_argmin(src: torch.Tensor, index: torch.Tensor, dim_size: int) -> torch.Tensor:
+    """
+    Find the argmin of src values that are scattered to the same index along the last dimension
+
+    Args:
+        src: (..., N) torch tensor containing values to compare
+        index: (..., N) torch tensor containing indices in [0, dim_size) to scatter src values to
+        dim_size: Size of the output along the last dimension
+
+    Returns:
+        argmin: (..., dim_size) torch tensor containing argmin values for each index, filled with N for indices that are not scattered to
+    """
+    with torch.no_grad():
+        num_src = src.shape[-1]
+        min_src = torch.full([*src.shape[:-1], dim_size], float('inf'), dtype=src.dtype, device=src.device)
+        min_src = min_src.scatter_reduce(-1, index, src, reduce='amin')
+
+        # Among the minimum values, choose the smallest index
+        src_idx = torch.arange(num_src, device=src.device).expand_as(index)
+        src_idx = torch.where(src == min_src.gather(-1, index), src_idx, torch.full_like(src_idx, num_src))
+        argmin = torch.full([*src.shape[:-1], dim_size], num_src, dtype=torch.long, device=src.device)
+        argmin = argmin.scatter_reduce(-1, index, src_idx, reduce='amin')
+
+    return argmin
+
+
 def refine_sampling_coords(img_idx: torch.tensor, rho: torch.tensor, rgb: torch.tensor, quantization: Tuple[int, int] = (1024, 2048), batched: bool = False,
     return_valid_mask: bool = False):
     """
@@ -1531,28 +1527,24 @@ def refine_sampling_coords(img_idx: torch.tensor, rho: torch.tensor, rgb: torch.
         H, W = quantization
         max_len = img_idx.shape[1]  # Number of total points
         # coord_key is shape (B, N)
-        coord_key = ((img_idx[..., 1] + 1.).clamp(min=0, max=2) / 2.0 * H).long() * W + (((img_idx[..., 0] + 1.).clamp(min=0, max=2) / 2.0) * W).long()  # (i-coordinate) * W + (j-coordinate)
+        norm_idx = img_idx.add(1.).clamp_(min=0, max=2).mul_(0.5)  # Image coordinates in [0, 1], computed in-place on a single buffer
+        coord_key = (norm_idx[..., 1] * H).long().mul_(W).add_((norm_idx[..., 0] * W).long())  # (i-coordinate) * W + (j-coordinate)
 
-        try:
-            _, argmin = scatter_min(rho, coord_key, dim=1)
-        except RuntimeError:
-            argmin = torch.arange(max_len).expand(coord_key.shape[0], -1)  # (B, N)
+        argmin = scatter_argmin(rho, coord_key, (H + 1) * W + 1)  # coord_key is at most (H + 1) * W
 
-        valid_mask = torch.zeros_like(coord_key, dtype=torch.bool, device=rgb.device)
-        for idx in range(coord_key.shape[0]):
-            valid_mask[idx, argmin[idx, argmin[idx] < max_len]] = True
+        # Scatter to an extra column which collects keys without points (argmin == max_len), then drop it
+        valid_mask = torch.zeros([coord_key.shape[0], max_len + 1], dtype=torch.bool, device=rgb.device)
+        valid_mask = valid_mask.scatter_(1, argmin, True)[:, :max_len]
 
         return argmin, valid_mask
     else:
         # Generate coordinate keys to aggregate from!
         H, W = quantization
 
-        coord_key = ((img_idx[:, 1] + 1.).clamp(min=0, max=2) / 2.0 * H).long() * W + (((img_idx[:, 0] + 1.).clamp(min=0, max=2) / 2.0) * W).long()  # (i-coordinate) * W + (j-coordinate)
+        norm_idx = img_idx.add(1.).clamp_(min=0, max=2).mul_(0.5)  # Image coordinates in [0, 1], computed in-place on a single buffer
+        coord_key = (norm_idx[..., 1] * H).long().mul_(W).add_((norm_idx[..., 0] * W).long())  # (i-coordinate) * W + (j-coordinate)
 
-        try:
-            _, argmin = scatter_min(rho, coord_key)
-        except RuntimeError:
-            argmin = torch.arange(len(img_idx))
+        argmin = scatter_argmin(rho, coord_key, (H + 1) * W + 1)  # coord_key is at most (H + 1) * W
 
         if return_valid_mask:
             valid_mask = torch.zeros_like(coord_key, dtype=torch.bool, device=rgb.device)
@@ -1563,7 +1555,8 @@ def refine_sampling_coords(img_idx: torch.tensor, rho: torch.tensor, rgb: torch.
             return argmin
 
 
-def sampling_loss_pose_search(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tensor, trans: torch.Tensor, rot: torch.Tensor, num_input: int) -> Tuple[torch.Tensor, torch.Tensor]:
+def sampling_loss_pose_search(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tensor, trans: torch.Tensor, rot: torch.Tensor, num_input: int,
+        rot_batch_size: int = 1) -> Tuple[torch.Tensor, torch.Tensor]:
     """
     Trim translation starting point & rotation by comparing sampling loss values
 
@@ -1574,6 +1567,7 @@ def sampling_loss_pose_search(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.T
         trans: (K, 3) torch tensor containing translation starting point candidates
         rot: (K, 3) torch tensor containing starting rotation candidates (yaw component)
         num_input: number to trim starting translation & rotation
+        rot_batch_size: Number of rotations whose samples are computed at once, where memory grows as O(rot_batch_size * N)
 
     Returns:
         trimmed_trans: (num_input, 3) torch tensor containing trimmed translation starting point
@@ -1584,26 +1578,26 @@ def sampling_loss_pose_search(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.T
     H, W, _ = img.shape
     loss_table = torch.zeros((len(trans), len(rot)), device=img.device)
 
+    # rotation matrices of all rotations
+    R = rot_from_ypr(rot)  # (K_rot, 3, 3)
+
     with tqdm(desc="Loss Initialization", total=len(trans) * len(rot)) as pbar:
         for i in range(len(trans)):
-            for j in range(len(rot)):
-                # rotation matrix
-                R = rot_from_ypr(rot[j])
+            for j in range(0, len(rot), rot_batch_size):
+                # Rotate the point cloud with a batch of rotations at once
+                new_xyz = torch.einsum('kab,nb->kna', R[j: j + rot_batch_size], xyz - trans[i])  # (B_rot, N, 3)
 
-                new_xyz = xyz.t() - trans[i].reshape(3, -1)
-                new_xyz = (torch.matmul(R, new_xyz)).t()
+                coord_arr = cloud2idx(new_xyz, batched=True)
+                sample_rgb = sample_from_img(img, coord_arr, batched=True)  # (B_rot, N, 3)
+                mask = (sample_rgb != 0).any(-1)
+                rgb_loss = (torch.norm(sample_rgb - rgb, dim=-1) * mask).sum(-1) / mask.sum(-1)
 
-                coord_arr = cloud2idx(new_xyz)
-                sample_rgb = sample_from_img(img, coord_arr)
-                mask = torch.sum(sample_rgb == 0, dim=1) != 3
-                rgb_loss = torch.norm(sample_rgb[mask] - rgb[mask], dim=-1).mean()
+                loss_table[i, j: j + rot_batch_size] = rgb_loss
 
-                loss_table[i, j] = rgb_loss
-
-                pbar.update(1)
+                pbar.update(len(rgb_loss))
 
     num_input = min(num_input, len(loss_table.flatten()))
-    min_inds = loss_table.flatten().argsort()[:num_input]
+    min_inds = loss_table.flatten().topk(num_input, largest=False)[1]
 
     trimmed_trans = trans[min_inds // len(rot)]
     trimmed_rot = rot[min_inds % len(rot)]
@@ -1639,54 +1633,43 @@ def direct_histogram_pose_search(img: torch.Tensor, xyz: torch.Tensor, rgb: torc
     H, W, _ = img.shape
 
     # masking coordinates to remove pixels whose RGB value is [0, 0, 0]
-    img_mask = torch.zeros([H, W], dtype=torch.bool, device=img.device)
-    img_mask[torch.sum(img == 0, dim=2) != 3] = True
+    img_mask = (img != 0).any(-1)
 
     # histograms are made from split images, then split histogram intersection is summed
     hist_intersect = torch.zeros((len(trans)), device=img.device)
-    hist_intersect_split = torch.zeros(num_split_h * num_split_w, device=img.device)
-    block_size_h = img.shape[0] // num_split_h
-    block_size_w = img.shape[1] // num_split_w
+
+    # Image histograms only depend on the image, and are computed once for all splits
+    img_hist = split_histogram(img, img_mask, num_split_h, num_split_w, num_bins, unit_range=False)  # (B, num_bins[0], ...)
+    img_valid = img_hist.flatten(1).sum(-1) != 0  # (B, )
+
+    # Splits on the top and bottom rows are excluded from the intersection
+    split_valid = torch.zeros(num_split_h, num_split_w, dtype=torch.bool, device=img.device)
+    split_valid[1: num_split_h - 1] = True
+    split_valid = torch.logical_and(split_valid.flatten(), img_valid)
+
+    # rotation matrices, where trans[i] and rot[i] form the i-th pose candidate
+    R = rot_from_ypr(rot)  # (K, 3, 3)
 
     with tqdm(desc="Hist Initialization", total=len(trans)) as pbar:
         for i in range(len(trans)):
-            # rotation matrix
-            R = rot_from_ypr(rot[i])
-
             # make panorama from xyz, rgb
-            proj_img = make_pano(torch.transpose(torch.matmul(R, torch.transpose(xyz - trans[i], 0, 1)), 0, 1), rgb, resolution=(img.shape[0], img.shape[1]), return_torch=True)
-            proj_mask = torch.zeros([proj_img.shape[0], proj_img.shape[1]], dtype=torch.bool, device=img.device)
-            proj_mask[torch.sum(proj_img == 0, dim=2) != 3] = True
-
-            for h in range(1, num_split_h - 1):
-                for w in range(num_split_w):
-                    # masking split section
-                    block_mask = torch.zeros([proj_img.shape[0], proj_img.shape[1]], dtype=torch.bool, device=img.device)
-                    block_mask[h * block_size_h: (h + 1) * block_size_h, w * block_size_w: (w + 1) * block_size_w] = True
-                    final_mask = torch.logical_and(proj_mask, img_mask)
-                    final_mask = torch.logical_and(final_mask, block_mask)
-                    final_img_mask = torch.logical_and(img_mask, block_mask)
-
-                    tgt_proj_rgb = proj_img[torch.nonzero(final_mask, as_tuple=True)]
-                    gt_proj_rgb = img[torch.nonzero(final_img_mask, as_tuple=True)]
-
-                    # Account for full masks
-                    if len(tgt_proj_rgb) == 0 or len(gt_proj_rgb) == 0:
-                        hist_intersect_split[h * num_split_w + w] = 0.0
-                        break
-
-                    proj_hist = histogram(proj_img, final_mask, num_bins)
-                    img_hist = histogram(img, final_img_mask, num_bins)
-                    hist_intersect_split[h * num_split_w + w] = histogram_intersection(img_hist, proj_hist)
-
-            # consider NaN
-            hist_intersect_split[torch.isnan(hist_intersect_split)] = 0.
-            hist_intersect[i] = hist_intersect_split.sum().item() / (num_split_h * num_split_w)
+            proj_img = make_pano(torch.transpose(torch.matmul(R[i], torch.transpose(xyz - trans[i], 0, 1)), 0, 1), rgb, resolution=(img.shape[0], img.shape[1]), return_torch=True)
+            final_mask = torch.logical_and((proj_img != 0).any(-1), img_mask)
+
+            # Histograms of all splits are computed with a single scatter
+            # img is scaled by 255 and make_pano returns colors in [0, 255], so the range is given to avoid synchronizing with the device
+            proj_hist = split_histogram(proj_img, final_mask, num_split_h, num_split_w, num_bins, unit_range=False)  # (B, num_bins[0], ...)
+            hist_intersect_split = batch_hist_intersection(img_hist, proj_hist)  # (B, )
+
+            # Account for full masks
+            proj_valid = proj_hist.flatten(1).sum(-1) != 0
+            hist_intersect_split = hist_intersect_split.masked_fill(torch.logical_not(torch.logical_and(split_valid, proj_valid)), 0.)
+
+            hist_intersect[i] = hist_intersect_split.sum() / (num_split_h * num_split_w)
 
             pbar.update(1)
 
-    min_inds = hist_intersect.flatten().argsort()[-num_input:]
-    min_inds = torch.flip(min_inds, [0])
+    min_inds = hist_intersect.flatten().topk(min(num_input, hist_intersect.numel()))[1]
     trimmed_trans = trans[min_inds]
     trimmed_rot = rot[min_inds]
 
@@ -1694,7 +1677,7 @@ def direct_histogram_pose_search(img: torch.Tensor, xyz: torch.Tensor, rgb: torc
 
 
 def sampling_histogram_pose_search(img: torch.Tensor, xyz: torch.Tensor, rgb: torch.Tensor, trans: torch.Tensor, rot: torch.Tensor, 
-        num_input: int, num_split_h: int, num_split_w: int, num_intermediate: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        num_input: int, num_split_h: int, num_split_w: int, num_intermediate: Optional[int] = None, rot_batch_size: int = 1) -> Tuple[torch.Tensor, torch.Tensor]:
     """
     Make translation & rotation starting point from sampling loss comparison followed by histogram comparison
 
@@ -1708,6 +1691,7 @@ def sampling_histogram_pose_search(img: torch.Tensor, xyz: torch.Tensor, rgb: to
         num_split_h: Number of split along horizontal direction
         num_split_w: Number of split along vertical direction
         num_intermediate: if criterion is 'loss_hist', num_intermediate is used for trim_input_loss
+        rot_batch_size: Number of rotations sampled at once in sampling_loss_pose_search
 
     Returns:
         input_trans: (num_input, 3) torch tensor containing starting translation points
@@ -1717,7 +1701,7 @@ def sampling_histogram_pose_search(img: torch.Tensor, xyz: torch.Tensor, rgb: to
     input_xyz = xyz
 
     # trim candidates
-    trimmed_trans, trimmed_rot = sampling_loss_pose_search(img, input_xyz, rgb, trans, rot, num_intermediate)
+    trimmed_trans, trimmed_rot = sampling_loss_pose_search(img, input_xyz, rgb, trans, rot, num_intermediate, rot_batch_size)
     input_trans, input_rot = direct_histogram_pose_search(img, input_xyz, rgb, trimmed_trans, trimmed_rot, 
         num_input, num_split_h, num_split_w)
 